@@ -1,32 +1,67 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory, send_file
+from flask import Flask, Response, request, jsonify, render_template, send_file
+from flask.json.provider import JSONProvider
+from werkzeug.exceptions import BadRequest
 from werkzeug.utils import secure_filename
 import os
-from typing import List, Dict, Tuple, Any
-from ifc_processing import process_ifc_file, add_escape_routes_to_ifc
-from grid_management import GridManager, validate_grid_data
+import numpy as np
+from typing import List, Dict, Tuple, Any, Optional
+from ifc_processing import process_ifc_file, add_escape_routes_to_ifc, PROCESSING_VERSION
+from grid_management import GridManager, validate_grid_data, pack_grids, unpack_grids, unpack_grid_array
 from pathfinding import Pathfinder, find_path, detect_exits, calculate_escape_route, calculate_escape_routes, check_escape_route_rules
-import json
-import webbrowser
-from threading import Timer
+import orjson
+import hashlib
+import multiprocessing
+import gzip
+import uuid
+import tempfile
+import shutil
+import subprocess
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
 
 from io import BytesIO
+from urllib.parse import quote
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 
 import logging
-import sys, traceback
+import sys
+
+try:
+    import brotli
+except ImportError:  # Optional; responses fall back to gzip
+    brotli = None
 
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-# Last created graph
-graphs = None
-hasGridChanged = True
-ifc_filepath = None
-origin_filepath = None
+# Recently created graphs, keyed by a hash of the grids and settings they were built from
+GRAPH_CACHE: 'OrderedDict[str, Tuple[Any, Pathfinder]]' = OrderedDict()
+# Grids being edited in the browser, so cell edits don't need to resend the whole grid stack
+GRID_STORE: 'OrderedDict[str, GridManager]' = OrderedDict()
+# Escape routes with their violations, keyed by graph, space, exits and spaces
+ROUTE_CACHE: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+# Requests run on separate threads, so the caches above (and TASKS) are only touched while holding this lock
+CACHE_LOCK = threading.Lock()
+
+class OrjsonProvider(JSONProvider):
+    """jsonify and request.json through orjson, which also serializes numpy arrays and scalars directly."""
+    options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, option=self.options).decode()
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=self.options), mimetype='application/json')
 
 if getattr(sys, 'frozen', False):
     template_folder = os.path.join(sys._MEIPASS, 'templates')
@@ -35,20 +70,63 @@ if getattr(sys, 'frozen', False):
 else:
     app = Flask(__name__)
 app.config.from_object('config')
+logging.basicConfig(level=app.config['LOG_LEVEL'])
+app.json = OrjsonProvider(app)
+ALLOWED_EXTENSIONS = frozenset(app.config['ALLOWED_EXTENSIONS'])
+
+# IFC processing, IFC export and PDF reports run here instead of in the request thread
+TASK_EXECUTOR = ThreadPoolExecutor(max_workers=app.config['TASK_WORKERS'])
+TASKS: 'OrderedDict[str, Future]' = OrderedDict()
+# IfcOpenShell export is CPU bound, so it runs in worker processes instead of holding the GIL in a task thread
+_export_pool = None
+_export_pool_lock = threading.Lock()
+
+def get_export_pool() -> ProcessPoolExecutor:
+    global _export_pool
+    with _export_pool_lock:
+        if _export_pool is None:
+            # spawn rather than fork: the web server is multi-threaded
+            _export_pool = ProcessPoolExecutor(max_workers=app.config['EXPORT_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+        return _export_pool
+
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL']),
+}
+if brotli is not None:
+    COMPRESSORS['br'] = lambda data: brotli.compress(data, quality=app.config['COMPRESS_BR_LEVEL'])
+
+def response_encoding() -> Optional[str]:
+    for encoding in app.config['COMPRESS_ALGORITHM']:
+        if encoding in COMPRESSORS and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+@app.after_request
+def compress_response(response):
+    # Grid payloads are long runs of the same cell codes and shrink many times over with brotli or gzip
+    if (response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in app.config['COMPRESS_MIMETYPES']):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = response_encoding()
+    if encoding is None:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(COMPRESSORS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 @app.route('/')
 def index() -> str:
-    return render_template('index.html')
+    # Versioned script URL, so browsers can cache it without holding on to an outdated copy
+    static_version = int(os.path.getmtime(os.path.join(app.static_folder, 'js', 'main.js')))
+    return render_template('index.html', static_version=static_version)
 
 @app.route('/api/process-file', methods=['POST'])
 def process_file() -> tuple[Dict[str, Any], int]:
-    global graphs
-    global hasGridChanged
-    global ifc_filepath
-    global origin_filepath
-    graphs = None
-    hasGridChanged = True
-    
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
@@ -56,30 +134,137 @@ def process_file() -> tuple[Dict[str, Any], int]:
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
     
-    if file and allowed_file(file.filename):
+    extension = file_extension(file.filename)
+    if file and extension in ALLOWED_EXTENSIONS:
         filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        origin_filepath = filepath
-        file.save(filepath)
-        
-        if file.filename.lower().endswith('.json'):
-            ifc_filepath = file.filename.replace('_edited.json', '.ifc')
+
+        # Edited JSON grids are loaded in the browser, so there is nothing to keep on the server
+        if extension == 'json':
             return jsonify({'output': 'Reset...'}), 200
         else:
-            ifc_filepath = file.filename
             grid_size = float(request.form.get('grid_size', 0.1))
-            try:
-                result = process_ifc_file(filepath, grid_size)
-                return jsonify(result), 200
-            except Exception as e:
-                app.logger.error(f"Error processing file: {str(e)}")
-                traceback.print_exc(file=sys.stdout)
-                return jsonify({'error': 'An error occurred while processing the file'}), 500
+            # The upload is only needed while processing, so it goes to a temporary file
+            with tempfile.NamedTemporaryFile(delete=False, suffix='.ifc') as tmp:
+                save_upload(file, tmp)
+            return submit_task(process_ifc_task, tmp.name, grid_size, filename)
     
     return jsonify({'error': 'Invalid file type'}), 400
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'ifc', 'json'}
+def process_ifc_task(filepath: str, grid_size: float, filename: str):
+    try:
+        # Processed models are cached by file content, so re-uploading the same IFC skips processing;
+        # the processing version keeps results of older code from being served
+        cache_path = os.path.join(app.config['IFC_CACHE_FOLDER'], f"{file_digest(filepath)}_{grid_size}_v{PROCESSING_VERSION}.json.gz")
+        if os.path.exists(cache_path):
+            logger.info(f"Using cached processing result {cache_path}")
+            # The cache holds the response body as-is, so it is sent without parsing it
+            with gzip.open(cache_path, 'rb') as f:
+                body = f.read()
+            return lambda: app.response_class(body, mimetype='application/json')
+
+        result = process_ifc_file(filepath, grid_size, packed=True)
+        if result is None:
+            # The processor logs its own errors and returns None; a failed run must not be cached
+            logger.error(f"Processing {filename} produced no result")
+            return json_result({'error': 'An error occurred while processing the file'}, 500)
+        with gzip.open(cache_path + '.tmp', 'wb') as f:
+            f.write(orjson.dumps(result))
+        os.replace(cache_path + '.tmp', cache_path)
+        return json_result(result)
+    except Exception:
+        logger.exception(f"Error processing file {filename}")
+        return json_result({'error': 'An error occurred while processing the file'}, 500)
+    finally:
+        os.remove(filepath)
+
+def submit_task(fn, *args) -> Tuple[Any, int]:
+    """Run fn in the background and answer 202; the client polls /api/task/<task_id> for the result."""
+    task_id = uuid.uuid4().hex
+    cache_put(TASKS, task_id, TASK_EXECUTOR.submit(fn, *args), app.config['TASK_STORE_SIZE'])
+    return jsonify({'task_id': task_id, 'status': 'pending'}), 202
+
+# Tasks return one of these; the response itself is built in the polling request, as send_file needs its context
+def json_result(payload: Dict[str, Any], status: int = 200):
+    return lambda: (jsonify(payload), status)
+
+def file_result(path_or_file, download_name: str, mimetype: str = None):
+    accel_prefix = app.config['X_ACCEL_REDIRECT_PREFIX']
+    if accel_prefix and isinstance(path_or_file, str):
+        # nginx serves the file from its internal location, so the worker doesn't stream it
+        def respond():
+            response = app.response_class(mimetype=mimetype or 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = accel_prefix + quote(os.path.basename(path_or_file))
+            response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+            return response
+        return respond
+    # conditional answers Range and If-Modified-Since requests for files on disk; the WSGI server's file_wrapper can sendfile() them
+    return lambda: send_file(path_or_file, as_attachment=True, download_name=download_name, mimetype=mimetype,
+                             conditional=isinstance(path_or_file, str), max_age=0)
+
+@app.route('/api/task/<task_id>', methods=['GET'])
+def task_status(task_id: str):
+    with CACHE_LOCK:
+        future = TASKS.get(task_id, (None, None))[1]
+        if future is None:
+            return jsonify({'error': 'Unknown task'}), 404
+        if not future.done():
+            return jsonify({'task_id': task_id, 'status': 'pending'}), 202
+        del TASKS[task_id]
+    try:
+        return future.result()()
+    except Exception as e:
+        logger.exception(f"Task {task_id} failed: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+def file_extension(filename: str) -> str:
+    # Empty when there is no dot, so such names never match an allowed extension
+    dot = filename.rfind('.')
+    return filename[dot + 1:].lower() if dot != -1 else ''
+
+def allowed_file(filename: str) -> bool:
+    return file_extension(filename) in ALLOWED_EXTENSIONS
+
+# Cache entries are (last used, value) pairs, kept in least recently used order
+def cache_get(cache: OrderedDict, key: str) -> Any:
+    now = time.monotonic()
+    with CACHE_LOCK:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if now - entry[0] > app.config['CACHE_TTL']:
+            del cache[key]
+            return None
+        cache[key] = (now, entry[1])
+        cache.move_to_end(key)
+        return entry[1]
+
+def cache_put(cache: OrderedDict, key: str, value: Any, max_size: int) -> None:
+    now = time.monotonic()
+    with CACHE_LOCK:
+        cache[key] = (now, value)
+        cache.move_to_end(key)
+        # Besides the size limit, drop entries nobody has used for CACHE_TTL, so idle sessions release their memory
+        while len(cache) > max_size or now - next(iter(cache.values()))[0] > app.config['CACHE_TTL']:
+            cache.popitem(last=False)
+
+def file_digest(filepath: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def save_upload(file, dst) -> None:
+    # IFC uploads can be hundreds of MB; copy them in large chunks rather than Werkzeug's default 16 KB
+    shutil.copyfileobj(file.stream, dst, app.config['UPLOAD_CHUNK_SIZE'])
+
+def get_request_json() -> Any:
+    # orjson parses the large grid payloads several times faster than the stdlib decoder,
+    # and cache=False avoids keeping a second copy of the raw body around
+    try:
+        return orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError as e:
+        raise BadRequest(f"Invalid JSON body: {e}")
 
 def validate_json_data(data):
     required_keys = ['grids', 'grid_size', 'floors', 'bbox']
@@ -87,51 +272,81 @@ def validate_json_data(data):
 
 @app.route('/api/edit-grid', methods=['POST'])
 def edit_grid() -> tuple[Dict[str, Any], int]:
-    global hasGridChanged
-    data = request.json
+    data = get_request_json()
     try:
-        grid_manager = GridManager(data['grids'], data['grid_size'], data['floors'], data['bbox'])
+        grid_manager = GridManager.from_view(unpack_grid_array(data['grids']), data['grid_size'], data['floors'], data['bbox'])
         updated_grids = grid_manager.edit_grid(data['edits'])
-        hasGridChanged = True
-        return jsonify({'grids': updated_grids}), 200
+        return jsonify({'grids': pack_grids(updated_grids)}), 200
     except Exception as e:
-        app.logger.error(f"Error editing grid: {str(e)}")
+        logger.error(f"Error editing grid: {str(e)}")
         return jsonify({'error': 'An error occurred while editing the grid'}), 500
 
 @app.route('/api/find-path', methods=['POST'])
 def find_path_route() -> tuple[Dict[str, Any], int]:
-    data = request.json
+    data = get_request_json()
     try:
-        path, path_lengths = find_path(
-            data['grids'], 
-            data['grid_size'], 
-            data['floors'], 
-            data['bbox'], 
-            data['start'], 
-            data['goals'],
-            data.get('allow_diagonal', False),
-            data.get('minimize_cost', True)
-        )
+        if 'graph_key' in data:
+            # Reuse the graph from create-graph instead of building it again
+            graphs = get_cached_graph(data['graph_key'])
+            if graphs is None:
+                return jsonify({'error': 'Graph not created'}), 400
+            path, path_lengths = graphs[1].find_path(data['start'], data['goals'])
+        else:
+            path, path_lengths = find_path(
+                unpack_grids(data['grids']),
+                data['grid_size'], 
+                data['floors'], 
+                data['bbox'], 
+                data['start'], 
+                data['goals'],
+                data.get('allow_diagonal', False),
+                data.get('minimize_cost', True)
+            )
         return jsonify({
             'path': path, 
             'path_lengths': path_lengths
         }), 200
     except Exception as e:
-        app.logger.error(f"Error finding path: {str(e)}")
+        logger.error(f"Error finding path: {str(e)}")
         return jsonify({'error': f'An error occurred while finding the path: {str(e)}'}), 500
 
+def store_grid_manager(grid_manager: GridManager) -> str:
+    grid_id = uuid.uuid4().hex
+    cache_put(GRID_STORE, grid_id, grid_manager, app.config['GRID_STORE_SIZE'])
+    return grid_id
+
+def get_edit_grid_manager(data: Dict[str, Any]) -> GridManager:
+    """Stored grid manager for data['grid_id'], or a new one from data['grids'] for clients that send the grids."""
+    grid_manager = cache_get(GRID_STORE, data.get('grid_id'))
+    if grid_manager is not None:
+        return grid_manager
+    if 'grids' in data:
+        return GridManager.from_view(unpack_grid_array(data['grids']), data['grid_size'], data['floors'], data['bbox'])
+    return None
+
+def get_buffered_grids(data: Dict[str, Any]) -> List[np.ndarray]:
+    """Buffered grids of the stored grid manager for data['grid_id'], or decoded from data['grids']."""
+    grid_manager = cache_get(GRID_STORE, data.get('grid_id'))
+    if grid_manager is not None:
+        # A copy, so edits made by other requests meanwhile don't change the grids under the caller
+        with grid_manager.lock:
+            return [grid.copy() for grid in grid_manager.buffered_grids]
+    if 'grids' in data:
+        validate_grid_data(data['grids'], data['grid_size'], data['floors'], data['bbox'])
+        return list(unpack_grid_array(data['grids']))
+    return None
+
 @app.route('/api/apply-wall-buffer', methods=['POST'])
 def apply_wall_buffer() -> Tuple[Dict[str, Any], int]:
-    global hasGridChanged
-    hasGridChanged = True
-    data = request.json
+    data = get_request_json()
     try:
         validate_grid_data(data['grids'], data['grid_size'], data['floors'], data['bbox'])
-        grid_manager = GridManager(data['grids'], data['grid_size'], data['floors'], data['bbox'])
+        grid_manager = GridManager.from_view(unpack_grid_array(data['grids']), data['grid_size'], data['floors'], data['bbox'])
         buffered_grids = grid_manager.apply_wall_buffer(int(data['wall_buffer']))
+        # The client sent the original grids, so only the buffered ones are sent back
         return jsonify({
-            'buffered_grids': buffered_grids,
-            'original_grids': grid_manager.get_original_grids()
+            'grid_id': store_grid_manager(grid_manager),
+            'buffered_grids': pack_grids(buffered_grids)
         }), 200
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}", exc_info=True)
@@ -142,61 +357,71 @@ def apply_wall_buffer() -> Tuple[Dict[str, Any], int]:
 
 @app.route('/api/update-cell', methods=['POST'])
 def update_cell() -> Tuple[Dict[str, Any], int]:
-    global hasGridChanged
-    hasGridChanged = True
-    data = request.json
+    data = get_request_json()
     try:
-        grid_manager = GridManager(data['grids'], data['grid_size'], data['floors'], data['bbox'])
-        grid_manager.update_cell(data['floor'], data['row'], data['col'], data['cell_type'])
-        buffered_grids = grid_manager.apply_wall_buffer(int(data['wall_buffer']))
+        floor, row, col = data['floor'], data['row'], data['col']
+        grid_manager = get_edit_grid_manager(data)
+        if grid_manager is None:
+            return jsonify({'error': 'Grid session expired', 'grid_expired': True}), 404
+        # Only the cells around the edit can change, so send back just that patch of the buffered grid
+        with grid_manager.lock:
+            grid_manager.update_cell(floor, row, col, data['cell_type'])
+            origin, patch = grid_manager.apply_wall_buffer_region(floor, row, col, row, col, int(data['wall_buffer']))
         return jsonify({
-            'buffered_grids': buffered_grids,
-            'original_grids': grid_manager.get_original_grids()
+            'floor': floor,
+            'origin': origin,
+            'buffered_patch': pack_grids([patch])
         }), 200
     except ValueError as e:
-        app.logger.error(f"Validation error: {str(e)}", exc_info=True)
+        logger.error(f"Validation error: {str(e)}", exc_info=True)
         return jsonify({'error': f'Invalid input data: {str(e)}'}), 400
     except Exception as e:
-        app.logger.error(f"Error updating cell: {str(e)}", exc_info=True)
+        logger.error(f"Error updating cell: {str(e)}", exc_info=True)
         return jsonify({'error': f'An error occurred while updating the cell: {str(e)}'}), 500
 
 @app.route('/api/batch-update-cells', methods=['POST'])
 def batch_update_cells():
-    global hasGridChanged
-    hasGridChanged = True
-    data = request.json
+    data = get_request_json()
     try:
-        grid_manager = GridManager(data['grids'], data['grid_size'], data['floors'], data['bbox'])
-        for update in data['updates']:
-            grid_manager.update_cell(update['floor'], update['row'], update['col'], update['type'])
-        buffered_grids = grid_manager.apply_wall_buffer(int(data['wall_buffer']))
-        return jsonify({
-            'original_grids': grid_manager.get_original_grids(),
-            'buffered_grids': buffered_grids
-        }), 200
+        grid_manager = get_edit_grid_manager(data)
+        if grid_manager is None:
+            return jsonify({'error': 'Grid session expired', 'grid_expired': True}), 404
+        # The client already holds the edited original grids; send back only the re-buffered areas
+        patches = []
+        with grid_manager.lock:
+            bounds = grid_manager.update_cells(data['updates'])
+            for floor, (row_min, col_min, row_max, col_max) in bounds.items():
+                origin, patch = grid_manager.apply_wall_buffer_region(floor, row_min, col_min, row_max, col_max, int(data['wall_buffer']))
+                patches.append({'floor': floor, 'origin': origin, 'buffered_patch': pack_grids([patch])})
+        return jsonify({'patches': patches}), 200
     except ValueError as e:
-        app.logger.error(f"Validation error: {str(e)}", exc_info=True)
+        logger.error(f"Validation error: {str(e)}", exc_info=True)
         return jsonify({'error': f'Invalid input data: {str(e)}'}), 400
     except Exception as e:
-        app.logger.error(f"Error updating cells: {str(e)}", exc_info=True)
+        logger.error(f"Error updating cells: {str(e)}", exc_info=True)
         return jsonify({'error': f'An error occurred while updating cells: {str(e)}'}), 500
     
 @app.route('/api/detect-exits', methods=['POST'])
 def detect_exits_route() -> tuple[Dict[str, Any], int]:
-    data = request.json
+    data = get_request_json()
     try:
-        exits = detect_exits(data['grids'], data['grid_size'], data['floors'], data['bbox'])
+        grids = get_buffered_grids(data)
+        if grids is None:
+            return jsonify({'error': 'Grid session expired', 'grid_expired': True}), 404
+        exits = detect_exits(grids, data['grid_size'], data['floors'], data['bbox'])
         return jsonify({'exits': exits}), 200
     except Exception as e:
-        app.logger.error(f"Error detecting exits: {str(e)}")
+        logger.error(f"Error detecting exits: {str(e)}")
         return jsonify({'error': f'An error occurred while detecting exits: {str(e)}'}), 500
 
 @app.route('/api/update-spaces', methods=['POST'])
 def detect_spaces_route() -> tuple[Dict[str, Any], int]:
-    data = request.json
+    data = get_request_json()
     try:
-        validate_grid_data(data['grids'], data['grid_size'], data['floors'], data['bbox'])
-        grid_manager = GridManager(data['grids'], data['grid_size'], data['floors'], data['bbox'])
+        grids = get_buffered_grids(data)
+        if grids is None:
+            return jsonify({'error': 'Grid session expired', 'grid_expired': True}), 404
+        grid_manager = GridManager.from_view(grids, data['grid_size'], data['floors'], data['bbox'])
         spaces = grid_manager.detect_spaces(data.get('include_empty_tiles', False))
         return jsonify({'spaces': spaces}), 200
     except ValueError as e:
@@ -206,37 +431,76 @@ def detect_spaces_route() -> tuple[Dict[str, Any], int]:
         logger.error(f"Error detecting spaces: {str(e)}", exc_info=True)
         return jsonify({'error': f'An error occurred while detecting spaces: {str(e)}'}), 500
     
+def graph_cache_key(grids_key: Any, data: Dict[str, Any]) -> str:
+    key_data = [grids_key, data['grid_size'], data['floors'], data['bbox'],
+                data['allow_diagonal'], data['minimize_cost']]
+    return hashlib.blake2b(orjson.dumps(key_data), digest_size=16).hexdigest()
+
+def get_cached_graph(graph_key: str = None) -> Tuple[Any, Pathfinder]:
+    if graph_key is None:
+        # Clients that don't send a key get the most recently built graph
+        with CACHE_LOCK:
+            return next(reversed(GRAPH_CACHE.values()), (None, None))[1]
+    return cache_get(GRAPH_CACHE, graph_key)
+
 @app.route('/api/create-graph', methods=['POST'])
 def api_create_graph():
-    global graphs
-    global hasGridChanged
-    data = request.json
+    data = get_request_json()
     try:
-        logger.debug(f"Received data for graph creation: {data.keys()}")
+        logger.debug("Received data for graph creation: %s", data.keys())
         
-        required_keys = ['original_grids', 'buffered_grids', 'grid_size', 'floors', 'bbox']
+        required_keys = ['grid_size', 'floors', 'bbox']
         for key in required_keys:
             if key not in data:
                 raise ValueError(f"Missing required key: {key}")
 
-        validate_grid_data(data['buffered_grids'], data['grid_size'], data['floors'], data['bbox'])
-        
-        pathfinder = Pathfinder(
-            data['original_grids'],
-            data['buffered_grids'],
-            data['grid_size'],
-            data['floors'],
-            data['bbox'],
-            data['allow_diagonal'],
-            data['minimize_cost']
-        )
-        #if not graphs:
-        #if hasGridChanged or not graphs:
-        graph = pathfinder.create_graph()
-        hasGridChanged = False
-        graphs = (graph, pathfinder)
-        
-        return jsonify({'status': 'success'})
+        # Stored grids are identified by grid_id and version; grids are only sent when the server no longer has them
+        grid_manager = cache_get(GRID_STORE, data.get('grid_id'))
+        if grid_manager is not None:
+            grids_key = [data['grid_id'], grid_manager.buffered_version]
+        else:
+            grids_key = data.get('grids', data.get('buffered_grids'))
+            if grids_key is None:
+                return jsonify({'error': 'Grid session expired', 'grid_expired': True}), 404
+
+        # Check the cache before decoding anything, a hit only needs the hash of the request
+        graph_key = graph_cache_key(grids_key, data)
+        if cache_get(GRAPH_CACHE, graph_key) is not None:
+            logger.debug("Reusing cached graph %s", graph_key)
+            return jsonify({'status': 'success', 'graph_key': graph_key})
+
+        if grid_manager is not None:
+            # Take the grids and their version together, so the graph is cached under the version it was built from
+            with grid_manager.lock:
+                grids_key = [data['grid_id'], grid_manager.buffered_version]
+                original_grids = [grid.tolist() for grid in grid_manager.original_grids]
+                buffered_grids = [grid.tolist() for grid in grid_manager.buffered_grids]
+            graph_key = graph_cache_key(grids_key, data)
+        else:
+            validate_grid_data(grids_key, data['grid_size'], data['floors'], data['bbox'])
+            buffered_grids = unpack_grids(grids_key)
+            original_grids = unpack_grids(data['original_grids']) if 'original_grids' in data else buffered_grids
+
+        # Toggling diagonal movement only adds or drops same-floor diagonal edges, so derive from the other variant if cached
+        sibling = get_cached_graph(graph_cache_key(grids_key, {**data, 'allow_diagonal': not data['allow_diagonal']}))
+        if sibling is not None:
+            logger.debug("Deriving graph %s from cached graph with allow_diagonal=%s", graph_key, not data['allow_diagonal'])
+            pathfinder = sibling[1].with_diagonal(data['allow_diagonal'])
+            graph = pathfinder.graph
+        else:
+            pathfinder = Pathfinder(
+                original_grids,
+                buffered_grids,
+                data['grid_size'],
+                data['floors'],
+                data['bbox'],
+                data['allow_diagonal'],
+                data['minimize_cost']
+            )
+            graph = pathfinder.create_graph()
+        cache_put(GRAPH_CACHE, graph_key, (graph, pathfinder), app.config['GRAPH_CACHE_SIZE'])
+
+        return jsonify({'status': 'success', 'graph_key': graph_key})
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}", exc_info=True)
         return jsonify({'error': f'Invalid input data: {str(e)}'}), 400
@@ -249,51 +513,74 @@ def api_create_graph():
 
 @app.route('/api/get-stair-connections', methods=['POST'])
 def get_stair_connections():
-    global graphs
-    data = request.json
+    data = get_request_json()
     try:
+        graphs = get_cached_graph(data.get('graph_key'))
         if graphs is None:
             return jsonify({'error': 'Graph not created'}), 400
 
         graph, pathfinder = graphs
-        floor = data['floor']
-
-        connections = []
-        for edge in graph.edges():
-            start_node, end_node = edge
-            if start_node[2] != end_node[2]:  # Different floors
-                connections.append({
-                    'start': start_node,
-                    'end': end_node
-                })
-
-        return jsonify(connections)
+        # Without a floor, return the connections of all floors
+        return jsonify(pathfinder.get_stair_connections(data.get('floor')))
     except Exception as e:
         logger.error(f"Error getting stair connections: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/calculate-escape-route', methods=['POST'])
 def api_calculate_escape_route():
-    data = request.json
+    data = get_request_json()
     try:
-        graph, pathfinder = graphs
-        
-        space = data['space']
-        exits = data['exits']
-        spaces = data['spaces']
-        
-        result = pathfinder.calculate_escape_route(space, exits, spaces)
-        violations = check_escape_route_rules(result, pathfinder.grid_size)
-        result['violations'] = violations
-        
-        return jsonify({'escape_route': result})
+        graphs = get_cached_graph(data.get('graph_key'))
+        if graphs is None:
+            return jsonify({'error': 'Graph not created'}), 400
+
+        results = escape_routes_with_violations(graphs[1], [data['space']], data['exits'], data['spaces'], data.get('graph_key'))
+        return jsonify({'escape_route': results[0]})
     except ValueError as e:
         logger.error(f"Validation error: {str(e)}", exc_info=True)
         return jsonify({'error': f'Invalid input data: {str(e)}'}), 400
     except Exception as e:
         logger.error(f"Error calculating escape route: {str(e)}", exc_info=True)
         return jsonify({'error': str(e)}), 500
+
+@app.route('/api/calculate-escape-routes', methods=['POST'])
+def api_calculate_escape_routes():
+    data = get_request_json()
+    try:
+        graphs = get_cached_graph(data.get('graph_key'))
+        if graphs is None:
+            return jsonify({'error': 'Graph not created'}), 400
+
+        # route_spaces lets the client send the spaces in batches; the full list is still needed for the stairways
+        route_spaces = data.get('route_spaces', data['spaces'])
+        results = escape_routes_with_violations(graphs[1], route_spaces, data['exits'], data['spaces'], data.get('graph_key'))
+        return jsonify({'escape_routes': results})
+    except ValueError as e:
+        logger.error(f"Validation error: {str(e)}", exc_info=True)
+        return jsonify({'error': f'Invalid input data: {str(e)}'}), 400
+    except Exception as e:
+        logger.error(f"Error calculating escape routes: {str(e)}", exc_info=True)
+        return jsonify({'error': str(e)}), 500
     
+def escape_routes_with_violations(pathfinder: Pathfinder, route_spaces: List[Dict[str, Any]], exits: List[List[int]], spaces: List[Dict[str, Any]], graph_key: str = None) -> List[Dict[str, Any]]:
+    if graph_key is None:
+        keys = [None] * len(route_spaces)
+    else:
+        # Routes only depend on the graph, the space, the exits and (for the stairways) all spaces,
+        # so recalculating unchanged spaces is answered from the cache
+        context = hashlib.blake2b(orjson.dumps([graph_key, exits, spaces]), digest_size=16).digest()
+        keys = [hashlib.blake2b(context + orjson.dumps(space), digest_size=16).hexdigest() for space in route_spaces]
+    results = [cache_get(ROUTE_CACHE, key) for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        for i, result in zip(missing, pathfinder.calculate_escape_routes([route_spaces[i] for i in missing], exits, spaces)):
+            result['violations'] = check_escape_route_rules(result, pathfinder.grid_size)
+            if keys[i] is not None:
+                cache_put(ROUTE_CACHE, keys[i], result, app.config['ROUTE_CACHE_SIZE'])
+            results[i] = result
+    return results
+
 @app.route('/api/update-ifc-with-routes', methods=['POST'])
 def api_update_ifc_with_routes():
     try:
@@ -309,136 +596,162 @@ def api_update_ifc_with_routes():
         if file and allowed_file(file.filename):
             filename = secure_filename(file.filename)
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            with open(filepath, 'wb') as f:
+                save_upload(file, f)
             logger.info(f"File saved to {filepath}")
             
-            routes = json.loads(request.form['routes'])
+            routes = orjson.loads(request.form['routes'])
             grid_size = float(request.form['grid_size'])
-            bbox = json.loads(request.form['bbox'])
-            floors = json.loads(request.form['floors'])
+            bbox = orjson.loads(request.form['bbox'])
+            floors = orjson.loads(request.form['floors'])
             
-            output_dir = os.path.join(app.config['UPLOAD_FOLDER'], "ifc_output")
-            os.makedirs(output_dir, exist_ok=True)
-            new_file = os.path.join(output_dir, filename.split(".")[0] + "_withroutes.ifc")
+            new_file = os.path.join(app.config['IFC_OUTPUT_FOLDER'], filename.split(".")[0] + "_withroutes.ifc")
             
-            logger.info(f"Processing IFC file: {filepath}")
-            logger.info(f"Output file: {new_file}")
-            
-            result = add_escape_routes_to_ifc(filepath, new_file, routes, grid_size, bbox, floors)
-            
-            if os.path.exists(new_file):
-                file_size = os.path.getsize(new_file)
-                logger.info(f"New IFC file created: {new_file}, size: {file_size} bytes")
-                return send_file(new_file, as_attachment=True, download_name=os.path.basename(new_file))
-            else:
-                logger.error(f"Failed to create new IFC file: {new_file}")
-                return jsonify({'error': 'Failed to create updated IFC file'}), 500
+            return submit_task(update_ifc_task, filepath, new_file, routes, grid_size, bbox, floors)
         else:
             logger.error(f"Invalid file type: {file.filename}")
             return jsonify({'error': 'Invalid file type'}), 400
     except Exception as e:
-        logger.error(f"Error updating IFC with routes: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception(f"Error updating IFC with routes: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def update_ifc_task(filepath: str, new_file: str, routes, grid_size: float, bbox: Dict[str, float], floors: List[Dict[str, Any]]):
+    logger.info(f"Processing IFC file: {filepath}")
+    logger.info(f"Output file: {new_file}")
+    
+    try:
+        get_export_pool().submit(add_escape_routes_to_ifc, filepath, new_file, routes, grid_size, bbox, floors).result()
+    except BrokenProcessPool:
+        global _export_pool
+        logger.warning("IFC export worker pool broke, exporting in-process")
+        with _export_pool_lock:
+            _export_pool = None
+        add_escape_routes_to_ifc(filepath, new_file, routes, grid_size, bbox, floors)
+    
+    if os.path.exists(new_file):
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"New IFC file created: {new_file}, size: {os.path.getsize(new_file)} bytes")
+        return file_result(new_file, os.path.basename(new_file))
+    else:
+        logger.error(f"Failed to create new IFC file: {new_file}")
+        return json_result({'error': 'Failed to create updated IFC file'}, 500)
+
 @app.route('/api/generate-pdf-report', methods=['POST'])
 def generate_pdf_report():
-    data = request.json
-    escape_routes = data['escape_routes']
-    grid_size = data['grid_size']
-    floors = data['floors']
+    data = get_request_json()
     filename = data['filename'].split(".", -1)[0]
-
+    return submit_task(pdf_report_task, data['escape_routes'], data['floors'], filename)
+
+# Built once; the report only reads the sample styles. A Spacer holds no layout state, so one instance is shared
+PDF_STYLES = getSampleStyleSheet()
+PDF_SPACER = Spacer(1, 12)
+PDF_TABLE_STYLE = [
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 14),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 12),
+    ('TOPPADDING', (0, 1), (-1, -1), 6),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+]
+
+def build_floor_section(floor_index: int, floor_count: int, floor: Dict[str, Any], routes: List[Tuple[Dict[str, Any], Dict[str, List[str]]]]) -> List[Any]:
+    """Heading and route table for one floor of the PDF report; routes are (route, non-empty violations) pairs."""
+    section = [Paragraph(f"Floor {floor_index+1}/{floor_count}: '{floor['name']}'", PDF_STYLES['Heading3'])]
+
+    table_data = [["Space", "Total Length (m)", "Length to Stairs (m)", "Violations"]]
+    # Row colors are collected with the rows, so the whole table is styled in one go
+    style = list(PDF_TABLE_STYLE)
+    for route, violations_by_type in routes:
+        total_length = route['distance'] if route['distance'] is not None else "N/A"
+        length_to_stairs = route['distance_to_stair'] if (route['distance_to_stair'] is not None and route['distance_to_stair'] > 0) else "N/A"
+        violations = ", ".join([v for vtype in violations_by_type.values() for v in vtype])
+        row = len(table_data)
+        table_data.append([
+            route['space_name'],
+            f"{total_length:.2f}" if isinstance(total_length, float) else total_length,
+            f"{length_to_stairs:.2f}" if isinstance(length_to_stairs, float) else length_to_stairs,
+            violations
+        ])
+        if 'general' in violations_by_type or 'daytime' in violations_by_type:
+            style.append(('BACKGROUND', (0, row), (-1, row), colors.pink))
+        elif 'nighttime' in violations_by_type:
+            style.append(('BACKGROUND', (0, row), (-1, row), colors.yellow))
+
+    if len(table_data) > 1:
+        section.append(Table(table_data, style=TableStyle(style)))
+    else:
+        section.append(Paragraph("No routes on this floor.", PDF_STYLES['BodyText']))
+    section.append(PDF_SPACER)
+    return section
+
+def pdf_report_task(escape_routes: List[Dict[str, Any]], floors: List[Dict[str, Any]], filename: str):
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
     elements = []
 
+    title, heading2, heading3, heading4, body_text = (PDF_STYLES[name] for name in ('Title', 'Heading2', 'Heading3', 'Heading4', 'BodyText'))
+
     # Title
-    elements.append(Paragraph("Escape Routes Report", styles['Title']))
-    elements.append(Paragraph(f"File: <u>{filename}.ifc</u>", styles['Heading2']))
-    elements.append(Spacer(1, 12))
+    elements.append(Paragraph("Escape Routes Report", title))
+    elements.append(Paragraph(f"File: <u>{filename}.ifc</u>", heading2))
+    elements.append(PDF_SPACER)
 
-    # Violations summary
-    elements.append(Paragraph("Routes with Violations:", styles['Heading2']))
+    # Violations summary; the same pass groups the routes by floor for the tables below
+    elements.append(Paragraph("Routes with Violations:", heading2))
+    routes_by_floor = defaultdict(list)
     for route in escape_routes:
-        if any(route['violations'].values()):
-            elements.append(Paragraph(f"Space: {route['space_name']}", styles['Heading3']))
-            for violation_type, violations in route['violations'].items():
-                if violations:
-                    elements.append(Paragraph(f"{violation_type.capitalize()}:", styles['Heading4']))
-                    for violation in violations:
-                        elements.append(Paragraph(f"- {violation}", styles['BodyText']))
-            elements.append(Spacer(1, 12))
+        # Only the violation types that occurred, so neither the summary nor the tables probe empty lists again
+        violations_by_type = {vtype: violations for vtype, violations in route['violations'].items() if violations}
+        routes_by_floor[int(route['starting_elevation'])].append((route, violations_by_type))
+        if violations_by_type:
+            elements.append(Paragraph(f"Space: {route['space_name']}", heading3))
+            for violation_type, violations in violations_by_type.items():
+                elements.append(Paragraph(f"{violation_type.capitalize()}:", heading4))
+                for violation in violations:
+                    elements.append(Paragraph(f"- {violation}", body_text))
+            elements.append(PDF_SPACER)
 
     # Table of all routes
-    elements.append(Paragraph("Overview of All Routes:", styles['Heading2']))
-    
+    elements.append(Paragraph("Overview of All Routes:", heading2))
     for floor_index, floor in enumerate(floors):
-        elements.append(Paragraph(f"Floor {floor_index+1}/{len(floors)}: '{floor['name']}'", styles['Heading3']))
-        
-        table_data = [["Space", "Total Length (m)", "Length to Stairs (m)", "Violations"]]
-        for route in escape_routes:
-            logger.debug(route['starting_elevation'])
-            if int(route['starting_elevation']) == floor_index:
-                total_length = route['distance'] if route['distance'] is not None else "N/A"
-                length_to_stairs = route['distance_to_stair'] if (route['distance_to_stair'] is not None and route['distance_to_stair'] > 0) else "N/A"
-                violations = ", ".join([v for vtype in route['violations'].values() for v in vtype]) if (route['violations'].items() is not None) else "None"
-                table_data.append([
-                    route['space_name'],
-                    f"{total_length:.2f}" if isinstance(total_length, float) else total_length,
-                    f"{length_to_stairs:.2f}" if isinstance(length_to_stairs, float) else length_to_stairs,
-                    violations
-                ])
-        
-        if len(table_data) > 1:
-            table = Table(table_data)
-            table.setStyle(TableStyle([
-                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-                ('FONTSIZE', (0, 0), (-1, 0), 14),
-                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-                ('TEXTCOLOR', (0, 1), (-1, -1), colors.black),
-                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-                ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-                ('FONTSIZE', (0, 1), (-1, -1), 12),
-                ('TOPPADDING', (0, 1), (-1, -1), 6),
-                ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
-                ('GRID', (0, 0), (-1, -1), 1, colors.black)
-            ]))
-
-            # Color rows based on violations
-            for i, route in enumerate(escape_routes):
-                if route['starting_elevation'] == floor_index:
-                    if route['violations']['general'] or route['violations']['daytime']:
-                        table.setStyle(TableStyle([('BACKGROUND', (0, i+1), (-1, i+1), colors.pink)]))
-                    elif route['violations']['nighttime']:
-                        table.setStyle(TableStyle([('BACKGROUND', (0, i+1), (-1, i+1), colors.yellow)]))
-
-            elements.append(table)
-            elements.append(Spacer(1, 12))
-        else:
-            elements.append(Paragraph("No routes on this floor.", styles['BodyText']))
-            elements.append(Spacer(1, 12))
+        elements.extend(build_floor_section(floor_index, len(floors), floor, routes_by_floor[floor_index]))
 
     doc.build(elements)
     buffer.seek(0)
     
-    return send_file(buffer, as_attachment=True, download_name=f"{filename}_report.pdf", mimetype='application/pdf')
+    return file_result(buffer, f"{filename}_report.pdf", 'application/pdf')
         
-@app.route('/static/<path:path>')
-def send_static(path: str) -> Any:
-    return send_from_directory('static', path)
-
-def allowed_file(filename: str) -> bool:
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
-
 def open_browser():
-      webbrowser.open_new("http://localhost:8000")
+    url = "http://localhost:8000"
+    # Hand the URL to the OS directly; webbrowser is only a fallback as it scans for browsers on import
+    if sys.platform == 'win32':
+        os.startfile(url)
+    elif shutil.which('xdg-open'):
+        subprocess.Popen(['xdg-open', url], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    else:
+        import webbrowser
+        webbrowser.open_new(url)
 
 if __name__ == '__main__':
-    Timer(1, open_browser).start()
-    app.run(host='localhost', debug=app.config['DEBUG'], port=8000)
+    # Needed for the floor worker processes in the frozen (PyInstaller) build
+    multiprocessing.freeze_support()
+    if app.config['OPEN_BROWSER']:
+        from threading import Timer
+        timer = Timer(1, open_browser)
+        timer.daemon = True
+        timer.start()
+    try:
+        from waitress import serve
+    except ImportError:  # Optional; the Werkzeug server below is used without it
+        serve = None
+    if serve is not None and not app.config['DEBUG']:
+        serve(app, host='localhost', port=8000, threads=app.config['SERVER_THREADS'])
+    else:
+        app.run(host='localhost', debug=app.config['DEBUG'], port=8000)
@@ -1,19 +1,59 @@
 import os
 
-# Flask settings
-DEBUG = False
+# Flask settings; FLASK_DEBUG=1 also runs the Werkzeug development server instead of waitress
+DEBUG = os.environ.get('FLASK_DEBUG') == '1'
+LOG_LEVEL = os.environ.get('LOG_LEVEL') or ('DEBUG' if DEBUG else 'INFO')
+# Open the UI in the default browser on start; set NO_BROWSER=1 on headless machines
+OPEN_BROWSER = not os.environ.get('NO_BROWSER')
+# Requests are served on threads in a single process (the Flask dev server is threaded by default):
+# the pathfinding graphs and edited grids are cached in memory between requests
+SERVER_THREADS = 8  # Request threads when served by waitress
+
+# Static files: cached by the browser for a day (the script URL is versioned), and
+# handed off to the front-end server with X-Sendfile when USE_X_SENDFILE=1 is set
+SEND_FILE_MAX_AGE_DEFAULT = 86400
+USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE') == '1'
+# Behind nginx: the internal location aliasing IFC_OUTPUT_FOLDER (e.g. /protected/),
+# so exported IFC files are sent by nginx through X-Accel-Redirect
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+
+# Response compression, in order of preference; 'br' is used when the brotli package is installed
+COMPRESS_ALGORITHM = ['br', 'gzip']
+COMPRESS_MIMETYPES = {'application/json'}
+COMPRESS_LEVEL = 4  # gzip
+COMPRESS_BR_LEVEL = 4  # brotli quality
+COMPRESS_MIN_SIZE = 4096  # Bytes; smaller responses are sent as-is
 SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
 
 # File upload settings
 UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'ifc', 'json'}
-MAX_CONTENT_LENGTH = 1000 * 1024 * 1024  # 16 MB limit
+ALLOWED_EXTENSIONS = frozenset({'ifc', 'json'})
+MAX_CONTENT_LENGTH = 1000 * 1024 * 1024  # 1000 MB limit
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes copied at a time when saving uploads
+
+# Processed IFC results, keyed by file content and grid size
+IFC_CACHE_FOLDER = os.path.join(UPLOAD_FOLDER, 'ifc_cache')
+# IFC files exported with the escape routes added
+IFC_OUTPUT_FOLDER = os.path.join(UPLOAD_FOLDER, 'ifc_output')
 
-# Ensure the upload folder exists
+# Ensure the upload folders exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(IFC_CACHE_FOLDER, exist_ok=True)
+os.makedirs(IFC_OUTPUT_FOLDER, exist_ok=True)
+
+# Stored grids, graphs and task results unused for this many seconds are dropped
+CACHE_TTL = 3600
+
+# Background tasks (IFC processing, IFC export, PDF reports)
+TASK_WORKERS = 2
+TASK_STORE_SIZE = 32  # Number of unclaimed task results kept in memory
+EXPORT_WORKERS = TASK_WORKERS  # Processes for IFC export, one per task worker is enough
 
 # Grid settings
 DEFAULT_GRID_SIZE = 0.1
+GRID_STORE_SIZE = 8  # Number of edited grid stacks kept in memory
 
 # Pathfinding settings
+GRAPH_CACHE_SIZE = 8  # Number of pathfinding graphs kept in memory (diagonal/cost variants count separately)
+ROUTE_CACHE_SIZE = 2048  # Number of escape routes kept in memory
 MAX_PATH_LENGTH = 1000  # Maximum number of steps in a path
\ No newline at end of file
@@ -1,10 +1,31 @@
 import numpy as np
 from typing import List, Dict, Tuple, Any
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import base64
+import os
 import logging
+import threading
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Cell types in the order of the uint8 codes used when grids are sent packed
+CELL_TYPES = ('empty', 'floor', 'stair', 'wall', 'door', 'walla')
+_SORTED_CELL_TYPES = np.array(sorted(CELL_TYPES))
+_SORTED_CELL_CODES = np.array([CELL_TYPES.index(cell_type) for cell_type in _SORTED_CELL_TYPES], dtype=np.uint8)
+
+# Below this many cells, starting work in other processes costs more than it saves
+PARALLEL_MIN_CELLS = 100_000
+_floor_pool = None
+
+def _get_floor_pool() -> ProcessPoolExecutor:
+    global _floor_pool
+    if _floor_pool is None:
+        # spawn rather than fork: the web server is multi-threaded
+        _floor_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+    return _floor_pool
+
 class GridManager:
     def __init__(self, grids: List[List[List[str]]], grid_size: float, floors: List[Dict[str, float]], bbox: Dict[str, float]):
         self.grid_size = grid_size
@@ -14,11 +35,35 @@ class GridManager:
         
         self.original_grids = []
         for i, grid in enumerate(grids):
-            if not grid:
+            if len(grid) == 0:
                 raise ValueError(f"Empty grid provided for floor {i}")
             self.original_grids.append(np.array(grid))
         
         self.buffered_grids = [grid.copy() for grid in self.original_grids]
+        self.grids = self.original_grids
+        # Bumped whenever the buffered grids change, so graphs built from them can be cached by version
+        self.buffered_version = 0
+        # Stored grid managers are shared between request threads; hold this while editing or copying the grids
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_view(cls, grids: List[np.ndarray], grid_size: float, floors: List[Dict[str, float]], bbox: Dict[str, float]) -> 'GridManager':
+        """Wrap already decoded floor arrays (or a (floors, rows, cols) array) without copying them."""
+        for i, grid in enumerate(grids):
+            if grid.ndim != 2 or grid.size == 0:
+                raise ValueError(f"Invalid grid provided for floor {i}")
+        grid_manager = cls.__new__(cls)
+        grid_manager.grid_size = grid_size
+        grid_manager.floors = floors
+        grid_manager.bbox = bbox
+        grid_manager.current_floor = 0
+        grid_manager.original_grids = list(grids)
+        # Buffered grids share the original arrays until they are buffered or written to
+        grid_manager.buffered_grids = list(grid_manager.original_grids)
+        grid_manager.grids = grid_manager.original_grids
+        grid_manager.buffered_version = 0
+        grid_manager.lock = threading.Lock()
+        return grid_manager
 
     def edit_grid(self, edits: List[Dict[str, Any]]) -> List[List[List[str]]]:
         """Apply multiple edits to the grid."""
@@ -133,49 +178,105 @@ class GridManager:
         else:
             raise ValueError("Cannot remove the specified floor")
 
-    def apply_wall_buffer(self, buffer_distance: int) -> List[List[List[str]]]:
+    def apply_wall_buffer(self, buffer_distance: int) -> List[np.ndarray]:
         #logger.debug(f"Applying wall buffer with distance: {buffer_distance}")
         #logger.debug(f"Original grids shape: {[grid.shape for grid in self.original_grids]}")
         
         try:
             for floor, original_grid in enumerate(self.original_grids):
-                buffered_grid = original_grid.copy()
-                wall_mask = (original_grid == 'wall')
-                
-                for _ in range(buffer_distance):
-                    wall_mask = self._expand_mask(wall_mask)
-
-                rows, cols = wall_mask.shape
-                for i in range(rows):
-                    for j in range(cols):
-                        if wall_mask[i, j] and original_grid[i, j] not in ['wall', 'door']:
-                            buffered_grid[i, j] = 'walla'
-                
-                self.buffered_grids[floor] = buffered_grid
+                self.buffered_grids[floor] = self._buffer_grid(original_grid, buffer_distance)
+            self.buffered_version += 1
 
             #logger.debug(f"Buffered grids shape: {[grid.shape for grid in self.buffered_grids]}")
-            return [grid.tolist() for grid in self.buffered_grids]
+            return self.buffered_grids
         except Exception as e:
             logger.error(f"Error in apply_wall_buffer: {str(e)}", exc_info=True)
             raise ValueError(f"Error applying wall buffer: {str(e)}")
 
-    def _expand_mask(self, mask: np.ndarray) -> np.ndarray:
-        expanded = mask.copy()
-        rows, cols = mask.shape
-        for i in range(rows):
-            for j in range(cols):
-                if mask[i, j]:
-                    for di in [-1, 0, 1]:
-                        for dj in [-1, 0, 1]:
-                            if 0 <= i + di < rows and 0 <= j + dj < cols:
-                                expanded[i + di, j + dj] = True
-        return expanded
+    def apply_wall_buffer_region(self, floor: int, row_min: int, col_min: int, row_max: int, col_max: int, buffer_distance: int) -> Tuple[Tuple[int, int], np.ndarray]:
+        """Re-buffer only the cells that edits inside the given (inclusive) bounds can affect."""
+        grid = self.original_grids[floor]
+        rows, cols = grid.shape
+        # Cells within buffer_distance of the edits can change; deciding them needs walls up to twice as far
+        top, bottom = max(row_min - buffer_distance, 0), min(row_max + buffer_distance + 1, rows)
+        left, right = max(col_min - buffer_distance, 0), min(col_max + buffer_distance + 1, cols)
+        window_top, window_left = max(row_min - 2 * buffer_distance, 0), max(col_min - 2 * buffer_distance, 0)
+        window = grid[window_top:min(row_max + 2 * buffer_distance + 1, rows), window_left:min(col_max + 2 * buffer_distance + 1, cols)]
+
+        buffered_window = self._buffer_grid(window, buffer_distance)
+        patch = buffered_window[top - window_top:bottom - window_top, left - window_left:right - window_left]
+        if self.buffered_grids[floor] is grid:
+            self.buffered_grids[floor] = grid.copy()
+        self.buffered_grids[floor][top:bottom, left:right] = patch
+        self.buffered_version += 1
+        return (top, left), patch
+
+    def _buffer_grid(self, grid: np.ndarray, buffer_distance: int) -> np.ndarray:
+        wall_mask = self._expand_mask(grid == 'wall', buffer_distance)
+        buffered_grid = grid.copy()
+        buffered_grid[wall_mask & (grid != 'wall') & (grid != 'door')] = 'walla'
+        return buffered_grid
+
+    def _expand_mask(self, mask: np.ndarray, distance: int) -> np.ndarray:
+        """Grow a boolean mask by `distance` cells in every direction, including diagonals."""
+        if distance <= 0:
+            return mask.copy()
+        # The square kernel is separable: a sliding-window OR over rows, then over columns
+        for _ in range(2):
+            counts = np.pad(mask, ((distance + 1, distance), (0, 0))).cumsum(axis=0, dtype=np.int32)
+            mask = (counts[2 * distance + 1:] - counts[:-2 * distance - 1] > 0).T
+        return mask
     
-    def update_cell(self, floor: int, row: int, col: int, cell_type: str) -> None:
-        if 0 <= floor < len(self.original_grids):
-            self.original_grids[floor][row, col] = cell_type
-        else:
+    def check_cell_update(self, floor: int, row: int, col: int, cell_type: str) -> None:
+        """Raise ValueError for an edit outside the grids or with an unknown cell type."""
+        if not 0 <= floor < len(self.original_grids):
             raise ValueError(f"Invalid floor number: {floor}")
+        # Negative indices would otherwise silently wrap around to the far edge of the grid
+        rows, cols = self.original_grids[floor].shape
+        if not (0 <= row < rows and 0 <= col < cols):
+            raise ValueError(f"Cell ({row}, {col}) is outside the {rows}x{cols} grid of floor {floor}")
+        if cell_type not in CELL_TYPES:
+            raise ValueError(f"Unknown cell type '{cell_type}'")
+
+    def update_cell(self, floor: int, row: int, col: int, cell_type: str) -> None:
+        self.check_cell_update(floor, row, col, cell_type)
+        self.original_grids[floor][row, col] = cell_type
+
+    def update_cells(self, updates: List[Dict[str, Any]]) -> Dict[int, Tuple[int, int, int, int]]:
+        """Apply {'floor', 'row', 'col', 'type'} edits with one assignment per floor.
+
+        All edits are checked before any is applied. Returns the (row_min, col_min, row_max, col_max)
+        bounds of the edited cells on each floor.
+        """
+        floors = np.array([update['floor'] for update in updates], dtype=np.int64)
+        rows = np.array([update['row'] for update in updates], dtype=np.int64)
+        cols = np.array([update['col'] for update in updates], dtype=np.int64)
+        types = np.array([update['type'] for update in updates], dtype=object)
+
+        unknown = ~np.isin(types, CELL_TYPES)
+        if unknown.any():
+            raise ValueError(f"Unknown cell type '{types[unknown][0]}'")
+        selections = {}
+        for floor in np.unique(floors).tolist():
+            if not 0 <= floor < len(self.original_grids):
+                raise ValueError(f"Invalid floor number: {floor}")
+            grid_rows, grid_cols = self.original_grids[floor].shape
+            # Later edits of the same cell win, as when they are applied one by one
+            selected = np.flatnonzero(floors == floor)[::-1]
+            cells = rows[selected] * grid_cols + cols[selected]
+            outside = (rows[selected] < 0) | (rows[selected] >= grid_rows) | (cols[selected] < 0) | (cols[selected] >= grid_cols)
+            if outside.any():
+                bad = selected[outside][-1]
+                raise ValueError(f"Cell ({rows[bad]}, {cols[bad]}) is outside the {grid_rows}x{grid_cols} grid of floor {floor}")
+            _, first = np.unique(cells, return_index=True)
+            selections[floor] = selected[first]
+
+        bounds = {}
+        for floor, selected in selections.items():
+            floor_rows, floor_cols = rows[selected], cols[selected]
+            self.original_grids[floor][floor_rows, floor_cols] = types[selected]
+            bounds[floor] = (int(floor_rows.min()), int(floor_cols.min()), int(floor_rows.max()), int(floor_cols.max()))
+        return bounds
 
     def get_original_grids(self) -> List[List[List[str]]]:
         return [grid.tolist() for grid in self.original_grids]
@@ -194,32 +295,51 @@ class GridManager:
         #logger.debug(f"Original grids shape: {[grid.shape for grid in self.original_grids]}")
         
         try:
-            spaces = []
-            for floor_index, grid in enumerate(self.original_grids):
-                space_id = 0
-                visited = np.zeros_like(grid, dtype=bool)
-                for i in range(grid.shape[0]):
-                    for j in range(grid.shape[1]):
-                        if not visited[i, j] and (grid[i, j] == 'floor' or (include_empty_tiles and grid[i, j] == 'empty')):
-                            space_id += 1
-                            space = self._flood_fill(grid, visited, i, j, floor_index, space_id, include_empty_tiles)
-                            if space:
-                                border = self._find_space_borders(grid, space['points'], include_empty_tiles)
-                                volume = len(space['points']) * (self.grid_size ** 2)
-                                area = len(border) * self.grid_size
-                                #logger.debug(f"Space {space_id} - Volume: {volume}, Area: {area}")
-                                if volume > 0.2:
-                                    space['polygon'] = self._create_polygon(border)
-                                    space['area'] = volume  # Calculate area
-                                    space['is_stairway'] = self._check_if_stairway(grid, border)  # Check for stairway
-                                    spaces.append(space)
+            floors = range(len(self.original_grids))
+            if len(floors) > 1 and (os.cpu_count() or 1) > 1 and sum(grid.size for grid in self.original_grids) >= PARALLEL_MIN_CELLS:
+                # Floors are independent, so each one is flood filled in its own process
+                try:
+                    floor_spaces = list(_get_floor_pool().map(
+                        _detect_floor_spaces, self.original_grids, floors,
+                        [self.grid_size] * len(floors), [self.bbox] * len(floors), [include_empty_tiles] * len(floors)))
+                except BrokenProcessPool:
+                    global _floor_pool
+                    logger.warning("Floor worker pool broke, detecting spaces in-process")
+                    _floor_pool = None
+                    floor_spaces = [self._detect_floor_spaces(grid, floor_index, include_empty_tiles) for floor_index, grid in enumerate(self.original_grids)]
+            else:
+                floor_spaces = [self._detect_floor_spaces(grid, floor_index, include_empty_tiles) for floor_index, grid in enumerate(self.original_grids)]
 
+            spaces = [space for spaces_on_floor in floor_spaces for space in spaces_on_floor]
             #logger.debug(f"Detected {len(spaces)} spaces")
             return spaces
         except Exception as e:
             logger.error(f"Error in detect_spaces: {str(e)}", exc_info=True)
             raise ValueError(f"Error detecting spaces: {str(e)}")
 
+    def _detect_floor_spaces(self, grid: np.ndarray, floor_index: int, include_empty_tiles: bool) -> List[Dict[str, Any]]:
+        spaces = []
+        space_id = 0
+        passable = grid == 'floor'
+        if include_empty_tiles:
+            passable |= grid == 'empty'
+        open_cells, width = open_cell_buffer(passable)
+        for cell in np.flatnonzero(open_cells).tolist():
+            if open_cells[cell]:
+                space_id += 1
+                space = self._flood_fill(open_cells, width, cell, floor_index, space_id)
+                if space:
+                    border = self._find_space_borders(grid, space['points'], include_empty_tiles)
+                    volume = len(space['points']) * (self.grid_size ** 2)
+                    area = len(border) * self.grid_size
+                    #logger.debug(f"Space {space_id} - Volume: {volume}, Area: {area}")
+                    if volume > 0.2:
+                        space['polygon'] = self._create_polygon(border)
+                        space['area'] = volume  # Calculate area
+                        space['is_stairway'] = self._check_if_stairway(grid, border)  # Check for stairway
+                        spaces.append(space)
+        return spaces
+
     def _check_if_stairway(self, grid: np.ndarray, points: List[Tuple[int, int]]) -> bool:
         """Check if a space touches a stair element."""
         for x, y in points:
@@ -229,25 +349,11 @@ class GridManager:
                     return True
         return False
 
-    def _flood_fill(self, grid, visited, i, j, floor_index, space_id, include_empty_tiles):
-        stack = [(i, j)]
-        points = []
-        allowed_types = {'floor', 'empty'} if include_empty_tiles else {'floor'}
-
-        while stack:
-            x, y = stack.pop()
-            if visited[x, y]:
-                continue
-            visited[x, y] = True
-            points.append((x, y))
-
-            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < grid.shape[0] and 0 <= ny < grid.shape[1]:
-                    if grid[nx, ny] in allowed_types and not visited[nx, ny]:
-                        stack.append((nx, ny))
-
-        if points:
+    def _flood_fill(self, open_cells, width, cell, floor_index, space_id):
+        filled = fill_open_cells(open_cells, width, cell)
+        if len(filled):
+            rows, cols = np.divmod(filled, width)
+            points = list(zip((rows - 1).tolist(), (cols - 1).tolist()))
             return {
                 "id": f"{floor_index}_{space_id}",
                 "name": f"Space {floor_index}_{space_id}",
@@ -293,11 +399,68 @@ class GridManager:
                  x * self.grid_size + self.bbox['min_y']) 
                 for x, y in border_points]
     
+def open_cell_buffer(passable: np.ndarray) -> Tuple[bytearray, int]:
+    """Flatten a 2D passable mask into a bytearray with a closed one-cell border.
+
+    Returns the buffer and its row width: cell (x, y) is at (x + 1) * width + y + 1,
+    and its neighbours are at +-1 and +-width without any bounds checks.
+    """
+    padded = np.pad(passable.astype(np.uint8), 1)
+    return bytearray(padded.tobytes()), padded.shape[1]
+
+def fill_open_cells(open_cells: bytearray, width: int, cell: int) -> np.ndarray:
+    """Scanline-fill the 4-connected region of open cells around cell in an open_cell_buffer.
+
+    The region is cleared in open_cells, which doubles as the visited set. Rows are contiguous in
+    the buffer, so every run is found with find/rfind and cleared with one slice assignment.
+    Returns the flat indices of the filled cells in row-major order.
+    """
+    runs = []
+    stack = [cell]
+    while stack:
+        cell = stack.pop()
+        if not open_cells[cell]:
+            continue
+        # The closed border guarantees a blocked cell on both ends of every row
+        start = open_cells.rfind(0, 0, cell) + 1
+        end = open_cells.find(0, cell)
+        open_cells[start:end] = bytes(end - start)
+        runs.append((start, end))
+        # Push one cell of every open span in the rows above and below the run
+        for row_start in (start - width, start + width):
+            row_end = row_start + end - start
+            span = open_cells.find(1, row_start, row_end)
+            while span != -1:
+                stack.append(span)
+                gap = open_cells.find(0, span, row_end)
+                if gap == -1:
+                    break
+                span = open_cells.find(1, gap, row_end)
+
+    runs.sort()
+    starts, ends = np.array(runs).T
+    lengths = ends - starts
+    # Expand the disjoint, sorted runs into consecutive indices
+    return np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+
+def _detect_floor_spaces(grid: np.ndarray, floor_index: int, grid_size: float, bbox: Dict[str, float], include_empty_tiles: bool) -> List[Dict[str, Any]]:
+    # Module-level entry point for the floor worker processes
+    return GridManager([grid], grid_size, [], bbox)._detect_floor_spaces(grid, floor_index, include_empty_tiles)
+
     # Helper function to validate input data
 def validate_grid_data(grids, grid_size, floors, bbox):
     #logger.debug(f"Validating grid data: grid_size={grid_size}, floors={floors}, bbox={bbox}")
     #logger.debug(f"Grids type: {type(grids)}")
-    
+
+    if isinstance(grids, dict):
+        # Packed grids: only the header is checked here, unpack_grids checks the cell codes themselves
+        shape = grids.get('shape')
+        if not isinstance(shape, list) or len(shape) != 3 or not all(isinstance(n, int) and n > 0 for n in shape):
+            raise ValueError(f"Packed grids must have a non-empty 3D shape, got {shape}")
+        if not isinstance(grids.get('data'), str):
+            raise ValueError("Packed grids are missing their data")
+        return
+
     if not isinstance(grids, list):
         raise ValueError(f"Grids must be a list, got {type(grids)}")
     if not grids:
@@ -311,18 +474,46 @@ def validate_grid_data(grids, grid_size, floors, bbox):
             raise ValueError(f"Grid {i} is an empty list")
         if not isinstance(grid[0], list):
             raise ValueError(f"Grid {i} must be a 2D list, got 1D list")
-    
-    for i, grid in enumerate(grids):
-        #logger.debug(f"Validating grid {i}: type={type(grid)}")
-        if not isinstance(grid, list):
-            raise ValueError(f"Grid {i} must be a list, got {type(grid)}")
-        if not grid:
-            logger.warning(f"Grid {i} is empty")
-            continue
-        if not isinstance(grid[0], list):
-            raise ValueError(f"Grid {i} must be a 2D list, got 1D list")
-        
-        grid_shape = (len(grid), len(grid[0]))
-        #logger.debug(f"Grid {i} dimensions: {grid_shape}")
 
-    #logger.debug(f"Grid data validated. Number of grids: {len(grids)}")
\ No newline at end of file
+    #logger.debug(f"Grid data validated. Number of grids: {len(grids)}")
+
+def pack_grids(grids) -> Dict[str, Any]:
+    """Encode equally sized floor grids as base64 uint8 cell codes for transport.
+
+    Grids are cell type names, or uint8 arrays that already hold the cell codes.
+    """
+    if all(isinstance(grid, np.ndarray) and grid.dtype == np.uint8 for grid in grids):
+        codes = np.asarray(grids)
+        if codes.ndim != 3:
+            raise ValueError(f"Grids must be 3D (floors, rows, cols), got shape {codes.shape}")
+        if codes.size and codes.max() >= len(CELL_TYPES):
+            raise ValueError(f"Unknown cell code {codes.max()}")
+        return {'shape': list(codes.shape), 'data': base64.b64encode(codes.tobytes()).decode('ascii')}
+
+    names = np.asarray(grids, dtype=str)
+    if names.ndim != 3:
+        raise ValueError(f"Grids must be 3D (floors, rows, cols), got shape {names.shape}")
+    index = np.searchsorted(_SORTED_CELL_TYPES, names).clip(0, len(CELL_TYPES) - 1)
+    unknown = _SORTED_CELL_TYPES[index] != names
+    if unknown.any():
+        raise ValueError(f"Unknown cell type '{names[unknown][0]}'")
+    codes = _SORTED_CELL_CODES[index]
+    return {'shape': list(codes.shape), 'data': base64.b64encode(codes.tobytes()).decode('ascii')}
+
+def unpack_grids(grids) -> List[List[List[str]]]:
+    """Decode grids packed by pack_grids; nested lists are passed through unchanged."""
+    if not isinstance(grids, dict):
+        return grids
+    return unpack_grid_array(grids).tolist()
+
+def unpack_grid_array(grids) -> np.ndarray:
+    """Decode packed (or nested list) grids into a (floors, rows, cols) array of cell types."""
+    if not isinstance(grids, dict):
+        return np.array(grids)
+    shape = tuple(grids['shape'])
+    codes = np.frombuffer(base64.b64decode(grids['data']), dtype=np.uint8)
+    if len(shape) != 3 or codes.size != np.prod(shape):
+        raise ValueError(f"Packed grid data does not match shape {shape}")
+    if codes.size and codes.max() >= len(CELL_TYPES):
+        raise ValueError(f"Unknown cell code {codes.max()}")
+    return np.array(CELL_TYPES)[codes.reshape(shape)]
@@ -8,7 +8,6 @@ import ifcopenshell.api
 import ifcopenshell.file
 import bpy
 import uuid
-import math
 import numpy as np
 from typing import Dict, List, Tuple, Any
 import traceback
@@ -17,8 +16,8 @@ import os, sys
 import mathutils
 
 from contextlib import contextmanager
+from grid_management import CELL_TYPES, open_cell_buffer, fill_open_cells, pack_grids
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Constants
@@ -27,6 +26,17 @@ FLOOR_TYPES = ['IfcSlab', 'IfcFloor']
 DOOR_TYPES = ['IfcDoor']
 STAIR_TYPES = ['IfcStair', 'IfcStairFlight']
 ALL_TYPES = WALL_TYPES + FLOOR_TYPES + DOOR_TYPES + STAIR_TYPES
+# IFC class name -> element type, so an element's type is a single dict lookup
+ELEMENT_TYPES = {**{t: 'wall' for t in WALL_TYPES}, **{t: 'floor' for t in FLOOR_TYPES},
+                 **{t: 'door' for t in DOOR_TYPES}, **{t: 'stair' for t in STAIR_TYPES}}
+
+# Part of the key of cached processing results; bump it whenever process() output changes for the same file
+PROCESSING_VERSION = 3
+
+# Grids are built as uint8 cell codes (the packed grid codes). empty < floor < stair < wall < door is also
+# the marking precedence, so a cell keeps the highest code marked on it
+CELL_CODES = {cell_type: code for code, cell_type in enumerate(CELL_TYPES)}
+CELL_NAMES = np.array(CELL_TYPES, dtype=object)
 
 class IFCProcessor:
     def __init__(self, file_path: str, grid_size: float = 0.2):
@@ -35,25 +45,37 @@ class IFCProcessor:
         self.ifc_file = None
         self.bbox = None
         self.floors = None
+        self.floor_elevations = None  # Sorted, for looking up the floor of a height
         self.grids = None
         self.unit_size = 1.0
         self.spaces = []
         self.global_transform = None
         self.include_empty_tiles = False
-
-    def process(self) -> Dict[str, Any]:
+        # World-coordinate geometry per element id, shared by the bounding box and rasterization passes
+        self.shape_cache = {}
+        # Elements looked up from the file's type index once, for all passes
+        self.bbox_items = []
+        self.elements = []
+
+    def process(self, packed: bool = False) -> Dict[str, Any]:
+        # packed returns the grids in pack_grids form straight from the cell codes, instead of as cell type names
         try:
             self.ifc_file = self.load_ifc_file()
             logger.info("IFC file loaded")
+            self.bbox_items = self.wall_elements()
+            self.elements = self.typed_elements()
+            self.tessellate_elements()
             self.bbox, self.floors = self.calculate_bounding_box_and_floors()
+            self.floor_elevations = np.array([floor['elevation'] for floor in self.floors])
             self.determine_unit_size()
             self.grids = self.create_grids()
             self.process_elements()
+            self.shape_cache.clear()
             #self.detect_spaces()
             self.trim_grids()
 
             return {
-                'grids': [grid.tolist() for grid in self.grids],
+                'grids': pack_grids(self.grids) if packed else [CELL_NAMES[grid].tolist() for grid in self.grids],
                 'bbox': self.bbox,
                 'floors': self.floors,
                 'grid_size': self.grid_size,
@@ -68,33 +90,24 @@ class IFCProcessor:
         self.spaces = []
         for floor_index, grid in enumerate(self.grids):
             space_id = 0
-            visited = np.zeros_like(grid, dtype=bool)
-            for i in range(grid.shape[0]):
-                for j in range(grid.shape[1]):
-                    if not visited[i, j] and (grid[i, j] == 'floor' or (self.include_empty_tiles and grid[i, j] == 'empty')):
-                        space_id += 1
-                        self.flood_fill(grid, visited, i, j, floor_index, space_id)
-
-    def flood_fill(self, grid, visited, i, j, floor_index, space_id):
-        stack = [(i, j)]
-        points = []
-        while stack:
-            x, y = stack.pop()
-            if visited[x, y]:
-                continue
-            visited[x, y] = True
-            points.append((x, y))
-            for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                nx, ny = x + dx, y + dy
-                if 0 <= nx < grid.shape[0] and 0 <= ny < grid.shape[1]:
-                    if not visited[nx, ny] and (grid[nx, ny] == 'floor' or (self.include_empty_tiles and grid[nx, ny] == 'empty')):
-                        stack.append((nx, ny))
-        
-        if points:
-            min_x = min(p[1] for p in points)
-            max_x = max(p[1] for p in points)
-            min_y = min(p[0] for p in points)
-            max_y = max(p[0] for p in points)
+            passable = grid == CELL_CODES['floor']
+            if self.include_empty_tiles:
+                passable |= grid == CELL_CODES['empty']
+            open_cells, width = open_cell_buffer(passable)
+            for cell in np.flatnonzero(open_cells).tolist():
+                if open_cells[cell]:
+                    space_id += 1
+                    self.flood_fill(open_cells, width, cell, floor_index, space_id)
+
+    def flood_fill(self, open_cells, width, cell, floor_index, space_id):
+        filled = fill_open_cells(open_cells, width, cell)
+        if len(filled):
+            rows, cols = np.divmod(filled, width)
+            rows -= 1
+            cols -= 1
+            min_y, max_y = int(rows.min()), int(rows.max())
+            min_x, max_x = int(cols.min()), int(cols.max())
+            points = list(zip(rows.tolist(), cols.tolist()))
             self.spaces.append({
                 "id": f"Space_{floor_index}_{space_id}",
                 "name": f"Space {space_id}",
@@ -134,19 +147,16 @@ class IFCProcessor:
                 logger.warning(f"Failed to process space {space.GlobalId}: {str(e)}")
 
     def extract_2d_points(self, verts, faces):
-        points = []
-        for i in range(0, len(verts), 3):
-            x = (verts[i] - self.bbox['min_x']) / self.grid_size
-            y = (verts[i+1] - self.bbox['min_y']) / self.grid_size
-            points.append((x, y))
-        return list(set(points))  # Remove duplicates
+        vertices = np.asarray(verts).reshape(-1, 3)
+        points = (vertices[:, :2] - (self.bbox['min_x'], self.bbox['min_y'])) / self.grid_size
+        return [tuple(point) for point in np.unique(points, axis=0).tolist()]  # Remove duplicates
 
     def determine_space_floor(self, verts):
-        z_coords = verts[2::3]
-        avg_z = sum(z_coords) / len(z_coords)
-        for i, floor in enumerate(self.floors):
-            if floor["elevation"] <= avg_z < floor["elevation"] + floor["height"]:
-                return i
+        avg_z = float(np.asarray(verts).reshape(-1, 3)[:, 2].mean())
+        # Floors don't overlap, so only the highest one starting at or below avg_z can contain it
+        i = int(np.searchsorted(self.floor_elevations, avg_z, side='right')) - 1
+        if i >= 0 and avg_z < self.floors[i]["elevation"] + self.floors[i]["height"]:
+            return i
         return -1  # If no matching floor is found
 
     def determine_unit_size(self):
@@ -165,20 +175,69 @@ class IFCProcessor:
         except Exception as e:
             raise RuntimeError(f"Error loading IFC file: {str(e)}")
 
-    def calculate_bounding_box_and_floors(self) -> Tuple[Dict[str, float], List[Dict]]:
+    def typed_elements(self) -> List[ifcopenshell.entity_instance]:
+        # Elements of exactly the ELEMENT_TYPES classes, taken from the file's type index instead of scanning every product
+        elements = []
+        for ifc_class in ELEMENT_TYPES:
+            try:
+                elements.extend(self.ifc_file.by_type(ifc_class, include_subtypes=False))
+            except RuntimeError:
+                pass  # Class not in this file's schema, e.g. IfcFloor
+        return elements
+
+    def wall_elements(self) -> List[ifcopenshell.entity_instance]:
+        # Elements of the WALL_TYPES classes and their subtypes, which set the bounding box.
+        # IfcWall also returns its IfcWallStandardCase subtypes; keep each element once, in file order
+        elements = {}
+        for type in WALL_TYPES:
+            elements.update(dict.fromkeys(self.ifc_file.by_type(type)))
+        return list(elements)
+
+    def tessellate_elements(self) -> None:
+        # Tessellate every element the bounding box and rasterization passes will ask for on
+        # ifcopenshell's thread pool up front; anything it skips falls back to create_shape
+        elements = set(self.bbox_items)
+        for element in self.elements:
+            elements.add(element)
+            elements.update(ifcopenshell.util.element.get_parts(element) or [])
+        elements = [element for element in elements if element.Representation]
+        if not elements:
+            return
+
         settings = ifcopenshell.geom.settings()
         settings.set(settings.USE_WORLD_COORDS, True)
+        threads = os.cpu_count() or 1
+        try:
+            iterator = ifcopenshell.geom.iterator(settings, self.ifc_file, threads, include=elements)
+            if iterator.initialize():
+                while True:
+                    shape = iterator.get()
+                    self.shape_cache[shape.id] = geometry_arrays(shape.geometry)
+                    if not iterator.next():
+                        break
+        except RuntimeError as e:
+            logger.warning(f"Geometry iterator failed, tessellating elements one by one: {str(e)}")
+        logger.info(f"Tessellated {len(self.shape_cache)} of {len(elements)} elements on {threads} threads")
+
+    def get_shape(self, element: ifcopenshell.entity_instance) -> Tuple[np.ndarray, np.ndarray]:
+        """Return an element's world-coordinate vertices (n, 3) and faces (m, 3), or None if it can't be tessellated."""
+        key = element.id()
+        if key not in self.shape_cache:
+            settings = ifcopenshell.geom.settings()
+            settings.set(settings.USE_WORLD_COORDS, True)
+            try:
+                self.shape_cache[key] = geometry_arrays(ifcopenshell.geom.create_shape(settings, element).geometry)
+            except RuntimeError:
+                self.shape_cache[key] = None
+        return self.shape_cache[key]
 
+    def calculate_bounding_box_and_floors(self) -> Tuple[Dict[str, float], List[Dict]]:
         bbox = {
             'min_x': float('inf'), 'min_y': float('inf'), 'min_z': float('inf'),
             'max_x': float('-inf'), 'max_y': float('-inf'), 'max_z': float('-inf')
         }
         floor_elevations = set()
-        bbox_items = []
-        for type in WALL_TYPES:
-            bbox_items += self.ifc_file.by_type(type)
-
-        bbox_items = list(set(bbox_items))
+        bbox_items = self.bbox_items
         logger.info(f"Number of bbox items to check: {len(bbox_items)}")
         curnum = 0
         totnum = 0
@@ -189,19 +248,17 @@ class IFCProcessor:
                 curnum = 0
                 logger.info(f"Done {totnum} out of {len(bbox_items)}.")
             if item.Representation:
-                try:
-                    shape = ifcopenshell.geom.create_shape(settings, item)
-                    verts = shape.geometry.verts
-                    for i in range(0, len(verts), 3):
-                        x, y, z = verts[i:i + 3]
-                        bbox['min_x'] = min(bbox['min_x'], x)
-                        bbox['min_y'] = min(bbox['min_y'], y)
-                        bbox['min_z'] = min(bbox['min_z'], z)
-                        bbox['max_x'] = max(bbox['max_x'], x)
-                        bbox['max_y'] = max(bbox['max_y'], y)
-                        bbox['max_z'] = max(bbox['max_z'], z)
-                except RuntimeError:
-                    pass
+                shape = self.get_shape(item)
+                if shape is not None and len(shape[0]):
+                    vertices = shape[0]
+                    x, y, z = vertices.min(axis=0).tolist()
+                    bbox['min_x'] = min(bbox['min_x'], x)
+                    bbox['min_y'] = min(bbox['min_y'], y)
+                    bbox['min_z'] = min(bbox['min_z'], z)
+                    x, y, z = vertices.max(axis=0).tolist()
+                    bbox['max_x'] = max(bbox['max_x'], x)
+                    bbox['max_y'] = max(bbox['max_y'], y)
+                    bbox['max_z'] = max(bbox['max_z'], z)
 
         logger.info(f"Calculated bounding box: {bbox}")
 
@@ -251,7 +308,7 @@ class IFCProcessor:
         logger.debug(floors)
         return bbox, floors
 
-    def create_grids(self) -> List[np.ndarray]:
+    def create_grids(self) -> np.ndarray:
         x_size = self.bbox['max_x'] - self.bbox['min_x']
         y_size = self.bbox['max_y'] - self.bbox['min_y']
 
@@ -263,82 +320,88 @@ class IFCProcessor:
         if x_cells > 10000 or y_cells > 10000:
             logger.warning(f"Very large grid size: {x_cells} x {y_cells}. This may cause performance issues.")
 
-        return [np.full((x_cells, y_cells), 'empty', dtype=object) for _ in self.floors]
+        # One contiguous (floors, x, y) block; self.grids[floor_index] is that floor's grid
+        return np.zeros((len(self.floors), x_cells, y_cells), dtype=np.uint8)
 
 
     def process_elements(self) -> None:
-        settings = ifcopenshell.geom.settings()
-        settings.set(settings.USE_WORLD_COORDS, True)
-
-        elements = [element for element in self.ifc_file.by_type('IfcProduct') if element.is_a() in ALL_TYPES]
+        elements = self.elements
+        # (element id, element type) pairs already marked: a part such as an IfcStairFlight is also
+        # listed under its own class, and marking it twice as the same type changes nothing
+        processed = set()
 
         for i, element in enumerate(elements):
             if i%25 == 0:
-                print(f"Processing element {i} out of {len(elements)}.")
+                logger.debug("Processing element %s out of %s.", i, len(elements))
             subelements = ifcopenshell.util.element.get_parts(element)
+            element_type = self.get_element_type(element)
             success = False
-            if element.Representation:
+            if element.Representation and (element.id(), element_type) not in processed:
+                processed.add((element.id(), element_type))
                 try:
-                    success = self.process_single_element(element, settings, self.get_element_type(element))
+                    success = self.process_single_element(element, element_type)
                 except Exception as e:
-                    logger.warning(f"Error processing element {element[0]}: {str(e)}")
+                    logger.warning("Error processing element %s: %s", element[0], e)
             if (True) and (subelements and len(subelements) > 0):
                 for subelement in subelements:
-                    if subelement.Representation:
+                    if subelement.Representation and (subelement.id(), element_type) not in processed:
+                        processed.add((subelement.id(), element_type))
                         try:
-                            success = self.process_single_element(subelement, settings, self.get_element_type(element))
+                            success = self.process_single_element(subelement, element_type)
                         except Exception as e:
-                            logger.warning(f"Error processing element {subelement[0]}: {str(e)}")
+                            logger.warning("Error processing element %s: %s", subelement[0], e)
 
-    def process_single_element(self, element, settings, element_type) -> None:
-        try:
-            shape = ifcopenshell.geom.create_shape(settings, element)
-            verts = shape.geometry.verts
-            faces = shape.geometry.faces
-        except RuntimeError as e:
-            #logger.warning(f"Failed to process: {element.is_a()} {element.id()}, Error: {str(e)}")
+    def process_single_element(self, element, element_type) -> None:
+        shape = self.get_shape(element)
+        if shape is None:
+            #logger.warning(f"Failed to process: {element.is_a()} {element.id()}")
             return False
+        vertices, faces = shape
 
         #element_type = self.get_element_type(element)
         if element_type is None:
             return False
 
-        if not verts:
-            print(f"Warning: No vertices found for {element.is_a()} (ID: {element.id()}), faces: " + str(len(faces)))
+        if len(vertices) == 0:
+            logger.debug("No vertices found for %s (ID: %s), faces: %s", element.is_a(), element.id(), len(faces))
             return False
         #else:
         #    print(f"Vertices found for {element.is_a()} (ID: {element.id()}), faces: " + str(len(faces)))
 
-        min_x = min(verts[i] for i in range(0, len(verts), 3))
-        max_x = max(verts[i] for i in range(0, len(verts), 3))
-        min_y = min(verts[i+1] for i in range(0, len(verts), 3))
-        max_y = max(verts[i+1] for i in range(0, len(verts), 3))
-        min_z = min(verts[i+2] for i in range(0, len(verts), 3))
-        max_z = max(verts[i+2] for i in range(0, len(verts), 3))
+        min_x, min_y, min_z = vertices.min(axis=0).tolist()
+        max_x, max_y, max_z = vertices.max(axis=0).tolist()
         if element_type == 'floor' or element_type == 'stair':
             if element_type == 'floor':
-                print(f"Floor {element[0]}: {min_z}, {max_z}; unit_size: {self.unit_size}")
+                logger.debug("Floor %s: %s, %s; unit_size: %s", element[0], min_z, max_z, self.unit_size)
                 min_z += 0.5/self.unit_size
             max_z += 1.5/self.unit_size # Extend the floors/stairs up so they get detected better
 
-        for floor_index, floor in enumerate(self.floors):
-            if min_z < floor['elevation'] + 2/self.unit_size and max_z > floor['elevation'] + 0.1/self.unit_size:
-                if element_type == 'door':
-                    # Use bounding box for doors
-                    self.mark_door(floor_index, min_x, min_y, max_x, max_y, floor)
-                #elif element_type == 'stair':
-                    # Use bounding box for doors
-                #    self.mark_stair(floor_index, min_x, min_y, max_x, max_y, floor)
-                else:
-                    # Use detailed geometry for other elements
-                    #if element_type == 'floor':
-                    #    print(faces)
-                    #    print(verts)
-                    for i in range(0, len(faces), 3):
-                        triangle = [verts[faces[i]*3:faces[i]*3+3],
-                                    verts[faces[i+1]*3:faces[i+1]*3+3],
-                                    verts[faces[i+2]*3:faces[i+2]*3+3]]
-                        self.mark_cells(triangle, self.grids[floor_index], floor, element_type)
+        # Floors whose lower 2 m the element reaches
+        floor_tops = self.floor_elevations + 2/self.unit_size
+        floor_indices = np.flatnonzero((min_z < floor_tops) & (max_z > self.floor_elevations + 0.1/self.unit_size)).tolist()
+        if not floor_indices:
+            return True
+
+        if element_type == 'door':
+            # Use bounding box for doors
+            for floor_index in floor_indices:
+                self.mark_door(floor_index, min_x, min_y, max_x, max_y, self.floors[floor_index])
+            return True
+
+        # Use detailed geometry for other elements: the extents of every triangle, shared by all floors
+        triangles = vertices[faces]
+        triangle_min = triangles.min(axis=1)
+        triangle_max = triangles.max(axis=1)
+        boxes = self.triangle_boxes(triangle_min, triangle_max)
+        if element_type == 'stair' or element_type == 'floor':
+            # Floors and stairs are marked whole on every floor they were matched to
+            for floor_index in floor_indices:
+                self.mark_cells(boxes, self.grids[floor_index], element_type)
+        else:
+            # Other triangles only mark the floors they reach: a (triangles, floors) mask
+            hits = (triangle_min[:, 2:3] < floor_tops) & (triangle_max[:, 2:3] > self.floor_elevations)
+            for floor_index in floor_indices:
+                self.mark_cells(boxes[hits[:, floor_index]], self.grids[floor_index], element_type)
         return True
 
     def mark_door(self, floor_index: int, min_x: float, min_y: float, max_x: float, max_y: float, floor: Dict[str, float]) -> None:
@@ -358,112 +421,59 @@ class IFCProcessor:
         end_x = int(min(float(self.grids[floor_index].shape[0] - 1), end_x))
         start_y = int(max(0, start_y))
         end_y = int(min(float(self.grids[floor_index].shape[1] - 1), end_y))
-        for x in range(start_x, end_x + 1):
-            for y in range(start_y, end_y + 1):
-                self.grids[floor_index][x, y] = 'door'
+        if end_x >= start_x and end_y >= start_y:
+            self.grids[floor_index][start_x:end_x + 1, start_y:end_y + 1] = CELL_CODES['door']
 
     def get_element_type(self, element: ifcopenshell.entity_instance) -> str:
-        if element.is_a() in WALL_TYPES:
-            return 'wall'
-        elif element.is_a() in DOOR_TYPES:
-            return 'door'
-        elif element.is_a() in STAIR_TYPES:
-            return 'stair'
-        elif element.is_a() in FLOOR_TYPES:
-            return 'floor'
-        else:
-            return None
-
-    def mark_cells(self, triangle: List[List[float]], grid: np.ndarray, floor: Dict[str, float], element_type: str) -> None:
-        min_x = min(p[0] for p in triangle)
-        max_x = max(p[0] for p in triangle)
-        min_y = min(p[1] for p in triangle)
-        max_y = max(p[1] for p in triangle)
-        min_z = min(p[2] for p in triangle)
-        max_z = max(p[2] for p in triangle)
-        
-        if element_type == 'floor' or element_type == 'stair':
-            if element_type == 'floor':
-                min_z += 0.3/self.unit_size
-            max_z += 1.5/self.unit_size # Extend the floors/stairs up so they get detected better
-
-        if element_type == 'stair' or element_type == 'floor' or (min_z < floor['elevation'] + 2/self.unit_size and max_z > floor['elevation']):
-            start_x = max(0, int((min_x - self.bbox['min_x']) / self.grid_size))
-            end_x = min(grid.shape[0] - 1, int((max_x - self.bbox['min_x']) / self.grid_size))
-            start_y = max(0, int((min_y - self.bbox['min_y']) / self.grid_size))
-            end_y = min(grid.shape[1] - 1, int((max_y - self.bbox['min_y']) / self.grid_size))
-
-            for x in range(start_x, end_x + 1):
-                for y in range(start_y, end_y + 1):
-                    current = grid[x, y]
-                    if element_type == 'door' or (element_type == 'wall' and current != 'door') or (
-                            element_type == 'stair' and current not in ['door', 'wall']) or (
-                            element_type == 'floor' and current == 'empty'):
-                        grid[x, y] = element_type
+        return ELEMENT_TYPES.get(element.is_a())
+
+    def triangle_boxes(self, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+        # lower/upper: (n, 3) minimum and maximum corners of each triangle, in world coordinates.
+        # Returns the (n, 4) cell ranges [start_x, end_x, start_y, end_y) they cover, clipped to the grids,
+        # so the transform is done once per element rather than once per floor
+        rows, cols = self.grids.shape[1:]
+        # astype truncates towards zero, like int()
+        start_x = np.maximum(0, ((lower[:, 0] - self.bbox['min_x']) / self.grid_size).astype(np.int64))
+        end_x = np.minimum(rows - 1, ((upper[:, 0] - self.bbox['min_x']) / self.grid_size).astype(np.int64))
+        start_y = np.maximum(0, ((lower[:, 1] - self.bbox['min_y']) / self.grid_size).astype(np.int64))
+        end_y = np.minimum(cols - 1, ((upper[:, 1] - self.bbox['min_y']) / self.grid_size).astype(np.int64))
+        return np.column_stack((start_x, end_x + 1, start_y, end_y + 1))
+
+    def mark_cells(self, boxes: np.ndarray, grid: np.ndarray, element_type: str) -> None:
+        # boxes: cell ranges from triangle_boxes; each triangle marks its bounding box
+        code = CELL_CODES[element_type]
+        boxes = boxes[(boxes[:, 1] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 2])]
+        # Neighbouring triangles of the same face usually share a bounding box
+        for x0, x1, y0, y1 in np.unique(boxes, axis=0).tolist():
+            cells = grid[x0:x1, y0:y1]
+            np.maximum(cells, code, out=cells)
 
     def trim_grids(self, padding: int = 1) -> None:
         logger.info("Starting grid trimming process")
-        trimmed_grids = []
-        min_x_global = float('inf')
-        max_x_global = float('-inf')
-        min_y_global = float('inf')
-        max_y_global = float('-inf')
-
-        all_empty = True
-
-        for i, grid in enumerate(self.grids):
-            #logger.debug(f"Processing grid {i}, shape: {grid.shape}")
-            non_empty = np.argwhere((grid != 'empty') & (grid != 'floor'))
-            if len(non_empty) == 0:
-                logger.warning(f"Grid {i} is entirely empty or floor, skipping trimming")
-                trimmed_grids.append(grid)
-                continue
-            
-            all_empty = False
-            min_x, min_y = non_empty.min(axis=0)
-            max_x, max_y = non_empty.max(axis=0)
-            #logger.debug(f"Grid {i} non-empty area: ({min_x}, {min_y}) to ({max_x}, {max_y})")
-
-            min_x_global = min(min_x_global, min_x)
-            max_x_global = max(max_x_global, max_x)
-            min_y_global = min(min_y_global, min_y)
-            max_y_global = max(max_y_global, max_y)
-
-
-        if all_empty:
+        if not len(self.grids):
+            return
+        # Cells holding anything besides floor, on any floor
+        occupied = self.grids > CELL_CODES['floor']
+        for i in np.flatnonzero(~occupied.any(axis=(1, 2))).tolist():
+            logger.warning(f"Grid {i} is entirely empty or floor")
+        footprint = occupied.any(axis=0)
+        rows = np.flatnonzero(footprint.any(axis=1))
+        cols = np.flatnonzero(footprint.any(axis=0))
+
+        if len(rows) == 0:
             logger.warning("All grids are empty or contain only floor cells. Skipping trimming.")
-            self.grids = [grid for grid in self.grids]  # Create a copy of the original grids
             return
-        
-        logger.info(f"Global non-empty area: ({min_x_global}, {min_y_global}) to ({max_x_global}, {max_y_global})")
-
-        for i, grid in enumerate(self.grids):
-            try:
-                # Ensure all indices are integers
-                start_x = max(0, int(min_x_global - padding))
-                end_x = min(grid.shape[0], int(max_x_global + padding + 1))
-                start_y = max(0, int(min_y_global - padding))
-                end_y = min(grid.shape[1], int(max_y_global + padding + 1))
-
-                #logger.debug(f"Trimming grid {i} from ({start_x}, {start_y}) to ({end_x}, {end_y})")
 
-                trimmed = grid[start_x:end_x, start_y:end_y]
-
-                # Add padding if necessary
-                padded = np.full((trimmed.shape[0] + 2 * padding, trimmed.shape[1] + 2 * padding), 'empty', dtype=object)
-                padded[padding:-padding, padding:-padding] = trimmed
-
-                trimmed_grids.append(padded)
-                #logger.debug(f"Grid {i} trimmed to shape: {padded.shape}")
-
-            except Exception as e:
-                logger.error(f"Error trimming grid {i}: {str(e)}")
-                logger.error(f"Grid shape: {grid.shape}")
-                logger.error(f"Attempted slice: [{start_x}:{end_x}, {start_y}:{end_y}]")
-                # If trimming fails, append the original grid
-                trimmed_grids.append(grid)
+        min_x_global, max_x_global = int(rows[0]), int(rows[-1])
+        min_y_global, max_y_global = int(cols[0]), int(cols[-1])
+        logger.info(f"Global non-empty area: ({min_x_global}, {min_y_global}) to ({max_x_global}, {max_y_global})")
 
-        self.grids = trimmed_grids
+        # All floors share one shape, so they are cut to the same window and padded with empty cells
+        start_x = max(0, min_x_global - padding)
+        end_x = min(footprint.shape[0], max_x_global + padding + 1)
+        start_y = max(0, min_y_global - padding)
+        end_y = min(footprint.shape[1], max_y_global + padding + 1)
+        self.grids = np.pad(self.grids[:, start_x:end_x, start_y:end_y], ((0, 0), (padding, padding), (padding, padding)))
 
         # Update bounding box
         x_size = self.grids[0].shape[0] * self.grid_size
@@ -477,9 +487,19 @@ class IFCProcessor:
         logger.info(f"Final grid dimensions: {self.grids[0].shape}")
         logger.info(f"Updated bounding box: {self.bbox}")
 
-def process_ifc_file(file_path: str, grid_size: float = 0.1) -> Dict[str, Any]:
+def geometry_arrays(geometry) -> Tuple[np.ndarray, np.ndarray]:
+    # The raw buffers are read directly instead of converting the verts/faces tuples element by element
+    try:
+        vertices = np.frombuffer(geometry.verts_buffer, dtype=np.float64)
+        faces = np.frombuffer(geometry.faces_buffer, dtype=np.int32)
+    except AttributeError:
+        vertices = np.asarray(geometry.verts, dtype=np.float64)
+        faces = np.asarray(geometry.faces)
+    return vertices.reshape(-1, 3), faces.reshape(-1, 3)
+
+def process_ifc_file(file_path: str, grid_size: float = 0.1, packed: bool = False) -> Dict[str, Any]:
     processor = IFCProcessor(file_path, grid_size)
-    return processor.process()
+    return processor.process(packed)
     
 def create_escape_route_segment(ifcfile, sb, body, storey, points, grid_type, width=0.8, height=1.5, plan_width=0.8, unit_scale=1.0, space_name="", floor_number = 0):
     unit_scale = 1
@@ -492,97 +512,42 @@ def create_escape_route_segment(ifcfile, sb, body, storey, points, grid_type, wi
     escape_route_3d = ifcopenshell.api.run("root.create_entity", ifcfile, ifc_class="IfcBuildingElementProxy", name=f"EscapeRoute3D_{space_name}_floor_{floor_number}")
     escape_route_plan = ifcopenshell.api.run("root.create_entity", ifcfile, ifc_class="IfcBuildingElementProxy", name=f"EscapeRoutePlan_{space_name}_floor_{floor_number}")
 
-    # Calculate offset points for left and right curves
-    left_points = []
-    right_points = []
-    plan_left_points = []
-    plan_right_points = []
-    
-    for i in range(len(points)):
-        #if path_info[i]['space'] and path_info[i]['space'] not in passed_spaces:
-        #    passed_spaces.append(path_info[i]['space'])
-        if i == 0:
-            dx = points[1][0] - points[0][0]
-            dy = points[1][1] - points[0][1]
-        elif i == len(points) - 1:
-            dx = points[-1][0] - points[-2][0]
-            dy = points[-1][1] - points[-2][1]
-        else:
-            dx1 = points[i][0] - points[i-1][0]
-            dy1 = points[i][1] - points[i-1][1]
-            dx2 = points[i+1][0] - points[i][0]
-            dy2 = points[i+1][1] - points[i][1]
-            dx = (dx1 + dx2) / 2
-            dy = (dy1 + dy2) / 2
-
-        length = math.sqrt(dx*dx + dy*dy)
-        if length <= 0:
-            length = 1
-        dx /= length
-        dy /= length
-
-        perpx = -dy
-        perpy = dx
-
-        # Adjust width and height based on path_info
-        current_width = width
-        current_height = height
-        current_plan_width = plan_width
-        
-        if grid_type[i] == 'door':
-            current_width *= 0.6  # Reduce width at doors
-            current_plan_width *= 0.6
-        elif grid_type[i] == 'stair':
-            current_width *= 0.6
-            current_plan_width *= 0.6
-
-        left_points.append((
-            points[i][0] + perpx * current_width/2,
-            points[i][1] + perpy * current_width/2,
-            points[i][2]
-        ))
-        right_points.append((
-            points[i][0] - perpx * current_width/2,
-            points[i][1] - perpy * current_width/2,
-            points[i][2]
-        ))
-        plan_left_points.append((
-            points[i][0] + perpx * current_plan_width/2,
-            points[i][1] + perpy * current_plan_width/2,
-            points[i][2]
-        ))
-        plan_right_points.append((
-            points[i][0] - perpx * current_plan_width/2,
-            points[i][1] - perpy * current_plan_width/2,
-            points[i][2]
-        ))
-
-    # Create vertices for the 3D polygon
-    vertices = []
-    for i in range(len(left_points)):
-        vertices.append(left_points[i])
-        vertices.append((left_points[i][0], left_points[i][1], left_points[i][2] + current_height))
-        vertices.append(right_points[i])
-        vertices.append((right_points[i][0], right_points[i][1], right_points[i][2] + current_height))
-
-    # Create edges for the 3D polygon
-    edges = []
-    n = len(left_points)
-    for i in range(0, 4*n-4, 4):
-        edges.extend([(i, i+4), (i+1, i+5), (i+2, i+6), (i+3, i+7)])
-        edges.extend([(i, i+1), (i+2, i+3)])
-        edges.extend([(i, i+2), (i+1, i+3)])
-    edges.extend([(4*n-4, 4*n-3), (4*n-2, 4*n-1), (4*n-4, 4*n-2), (4*n-3, 4*n-1)])
-
-    # Create faces for the 3D polygon
-    faces = []
-    for i in range(0, 4*n-4, 4):
-        faces.append([i, i+4, i+5, i+1])
-        faces.append([i+2, i+3, i+7, i+6])
-        faces.append([i, i+2, i+6, i+4])
-        faces.append([i+1, i+5, i+7, i+3])
-    faces.append([0, 1, 3, 2])
-    faces.append([4*n-4, 4*n-2, 4*n-1, 4*n-3])
+    # Direction of travel at each point: the first and last segments at the ends, the mean of the
+    # two adjacent segments in between
+    xyz = np.asarray(points, dtype=np.float64)
+    n = len(xyz)
+    steps = np.diff(xyz[:, :2], axis=0)
+    directions = np.empty((n, 2))
+    directions[0] = steps[0]
+    directions[-1] = steps[-1]
+    directions[1:-1] = (steps[:-1] + steps[1:]) / 2
+    length = np.sqrt(directions[:, 0] * directions[:, 0] + directions[:, 1] * directions[:, 1])
+    length[length <= 0] = 1
+    directions /= length[:, None]
+    perpendicular = np.column_stack((-directions[:, 1], directions[:, 0]))
+
+    # Routes narrow at doors and stairs
+    narrow = np.array([grid_type[i] in ('door', 'stair') for i in range(n)], dtype=bool)
+    narrowing = np.where(narrow, 0.6, 1.0)
+
+    # Each point contributes four vertices: left, left raised, right, right raised
+    def band_vertices(band_width, band_height):
+        offset = perpendicular * (band_width * narrowing)[:, None] / 2
+        left = np.column_stack((xyz[:, :2] + offset, xyz[:, 2]))
+        right = np.column_stack((xyz[:, :2] - offset, xyz[:, 2]))
+        raise_z = np.array([0, 0, band_height])
+        return np.stack((left, left + raise_z, right, right + raise_z), axis=1).reshape(-1, 3).tolist()
+
+    # Edges and faces between the vertices of consecutive points, then the two end caps
+    base = 4 * np.arange(n - 1)[:, None]
+    end = 4 * n - 4
+    caps = [[0, 1, 3, 2], [end, end + 2, end + 3, end + 1]]
+    edges = (base[:, :, None] + np.array([(0, 4), (1, 5), (2, 6), (3, 7), (0, 1), (2, 3), (0, 2), (1, 3)])).reshape(-1, 2).tolist()
+    edges += [[end, end + 1], [end + 2, end + 3], [end, end + 2], [end + 1, end + 3]]
+
+    # Create vertices, edges and faces for the 3D polygon
+    vertices = band_vertices(width, height)
+    faces = (base[:, :, None] + np.array([(0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)])).reshape(-1, 4).tolist() + caps
 
     # Create mesh representation for 3D geometry
     representation_3d = ifcopenshell.api.run(
@@ -594,26 +559,9 @@ def create_escape_route_segment(ifcfile, sb, body, storey, points, grid_type, wi
         faces=[faces]
     )
 
-    # Create vertices for the plan view polygon
-    plan_vertices = []
-    for i in range(len(plan_left_points)):
-        plan_vertices.append(plan_left_points[i])
-        plan_vertices.append((plan_left_points[i][0], plan_left_points[i][1], plan_left_points[i][2] + plan_height))
-        plan_vertices.append(plan_right_points[i])
-        plan_vertices.append((plan_right_points[i][0], plan_right_points[i][1], plan_right_points[i][2] + plan_height))
-
-    # Create edges and faces for the plan view polygon (similar to 3D polygon)
-    plan_edges = []
-    plan_faces = []
-    for i in range(0, 4*n-4, 4):
-        plan_edges.extend([(i, i+4), (i+1, i+5), (i+2, i+6), (i+3, i+7)])
-        plan_edges.extend([(i, i+1), (i+2, i+3)])
-        plan_edges.extend([(i, i+2), (i+1, i+3)])
-        plan_faces.append([i, i+4, i+6, i+2])
-        plan_faces.append([i+1, i+3, i+7, i+5])
-    plan_edges.extend([(4*n-4, 4*n-3), (4*n-2, 4*n-1), (4*n-4, 4*n-2), (4*n-3, 4*n-1)])
-    plan_faces.append([0, 1, 3, 2])
-    plan_faces.append([4*n-4, 4*n-2, 4*n-1, 4*n-3])
+    # Create vertices and faces for the plan view polygon, sharing the 3D polygon's edges
+    plan_vertices = band_vertices(plan_width, plan_height)
+    plan_faces = (base[:, :, None] + np.array([(0, 4, 6, 2), (1, 3, 7, 5)])).reshape(-1, 4).tolist() + caps
 
     # Create mesh representation for plan view geometry
     representation_plan = ifcopenshell.api.run(
@@ -621,7 +569,7 @@ def create_escape_route_segment(ifcfile, sb, body, storey, points, grid_type, wi
         ifcfile,
         context=body,
         vertices=[plan_vertices],
-        edges=[plan_edges],
+        edges=[edges],
         faces=[plan_faces]
     )
 
@@ -682,9 +630,10 @@ def add_escape_routes_to_ifc(original_file, new_file, routes, grid_size, bbox, f
     escape_routes_3d_group = ifcfile.create_entity("IfcGroup", Name="EscapeRoutes3D")
     escape_routes_plan_group = ifcfile.create_entity("IfcGroup", Name="EscapeRoutesPlan")
 
-    # Assign 3D and plan groups to the main escape routes group
-    ifcopenshell.api.run("group.assign_group", ifcfile, group=escape_routes_group, products=[escape_routes_3d_group, escape_routes_plan_group])
-
+    # Group members are collected while the routes are built and assigned once per group at the end
+    group_members = {escape_routes_group: [escape_routes_3d_group, escape_routes_plan_group]}
+    # One surface style per route colour, shared by all segments
+    route_styles = {}
 
     # Create floor groups for 3D and plan
     floor_groups_3d = {}
@@ -692,8 +641,8 @@ def add_escape_routes_to_ifc(original_file, new_file, routes, grid_size, bbox, f
     for floor_index in range(len(floors)):
         floor_group_3d = ifcfile.create_entity("IfcGroup", Name=f"EscapeRoutes3D_Floor_{floor_index}")
         floor_group_plan = ifcfile.create_entity("IfcGroup", Name=f"EscapeRoutesPlan_Floor_{floor_index}")
-        ifcopenshell.api.run("group.assign_group", ifcfile, group=escape_routes_3d_group, products=[floor_group_3d])
-        ifcopenshell.api.run("group.assign_group", ifcfile, group=escape_routes_plan_group, products=[floor_group_plan])
+        group_members.setdefault(escape_routes_3d_group, []).append(floor_group_3d)
+        group_members.setdefault(escape_routes_plan_group, []).append(floor_group_plan)
         floor_groups_3d[floor_index] = floor_group_3d
         floor_groups_plan[floor_index] = floor_group_plan
 
@@ -702,7 +651,7 @@ def add_escape_routes_to_ifc(original_file, new_file, routes, grid_size, bbox, f
         
         # Create IfcGroup for the specific route
         route_group = ifcfile.create_entity("IfcGroup", Name=f"EscapeRoute_{route['space_name']}")
-        ifcopenshell.api.run("group.assign_group", ifcfile, group=escape_routes_group, products=[route_group])
+        group_members[escape_routes_group].append(route_group)
 
         # Prepare route properties
         prop_dict = {
@@ -781,20 +730,23 @@ def add_escape_routes_to_ifc(original_file, new_file, routes, grid_size, bbox, f
                 add_properties_to_element(ifcfile, segment_plan, prop_dict)
 
                 # Add route segments to respective groups
-                ifcopenshell.api.run("group.assign_group", ifcfile, group=floor_groups_3d[floor_index], products=[segment_3d])
-                ifcopenshell.api.run("group.assign_group", ifcfile, group=floor_groups_plan[floor_index], products=[segment_plan])
-                ifcopenshell.api.run("group.assign_group", ifcfile, group=route_group, products=[segment_3d, segment_plan])
+                group_members.setdefault(floor_groups_3d[floor_index], []).append(segment_3d)
+                group_members.setdefault(floor_groups_plan[floor_index], []).append(segment_plan)
+                group_members.setdefault(route_group, []).extend([segment_3d, segment_plan])
 
                 # Set color (green for routes with no violations, red for with, orange for only nighttime)
                 if has_violations and has_violations_day_general:
-                    set_color(ifcfile, segment_3d, (1.0, 0.5, 0.5))
-                    set_color(ifcfile, segment_plan, (1.0, 0.5, 0.5))
+                    set_color(ifcfile, segment_3d, (1.0, 0.5, 0.5), route_styles)
+                    set_color(ifcfile, segment_plan, (1.0, 0.5, 0.5), route_styles)
                 elif has_violations and not has_violations_day_general:
-                    set_color(ifcfile, segment_3d, (1.0, 0.7, 0.1))
-                    set_color(ifcfile, segment_plan, (1.0, 0.7, 0.1))
+                    set_color(ifcfile, segment_3d, (1.0, 0.7, 0.1), route_styles)
+                    set_color(ifcfile, segment_plan, (1.0, 0.7, 0.1), route_styles)
                 else:
-                    set_color(ifcfile, segment_3d, (0.5, 1.0, 0.5))
-                    set_color(ifcfile, segment_plan, (0.5, 1.0, 0.5))
+                    set_color(ifcfile, segment_3d, (0.5, 1.0, 0.5), route_styles)
+                    set_color(ifcfile, segment_plan, (0.5, 1.0, 0.5), route_styles)
+
+    for group, products in group_members.items():
+        ifcopenshell.api.run("group.assign_group", ifcfile, group=group, products=products)
 
     ifcfile.write(new_file)
     return {"new_file_path": new_file}
@@ -837,11 +789,17 @@ def create_polygon_segment(ifcfile, sb, body, storey, points, elevation):
 
     return polygon_segment
 
-def set_color(ifcfile, product, color):
-    style = ifcopenshell.api.run("style.add_style", ifcfile, name=f"Color_{product.Name}")
-    ifcopenshell.api.run("style.add_surface_style", ifcfile, style=style, ifc_class="IfcSurfaceStyleShading", attributes={
-        "SurfaceColour": { "Name": None, "Red": color[0], "Green": color[1], "Blue": color[2] }
-    })
+def set_color(ifcfile, product, color, styles=None):
+    # With a styles dict, products of the same colour share one style instead of each getting their own
+    style = styles.get(color) if styles is not None else None
+    if style is None:
+        name = f"Color_{product.Name}" if styles is None else "Color_{:g}_{:g}_{:g}".format(*color)
+        style = ifcopenshell.api.run("style.add_style", ifcfile, name=name)
+        ifcopenshell.api.run("style.add_surface_style", ifcfile, style=style, ifc_class="IfcSurfaceStyleShading", attributes={
+            "SurfaceColour": { "Name": None, "Red": color[0], "Green": color[1], "Blue": color[2] }
+        })
+        if styles is not None:
+            styles[color] = style
     ifcopenshell.api.run("style.assign_representation_styles", ifcfile, shape_representation=product.Representation.Representations[0], styles=[style])
 
 
@@ -855,13 +813,11 @@ def prepare_route_points(optimal_path, grid_size, bbox, elevation, floors):
 
 def add_properties_to_group(ifcfile, group, properties):
     property_set = ifcopenshell.api.run("pset.add_pset", ifcfile, products=[group], name="EscapeRouteProperties")
-    for name, value in properties.items():
-        ifcopenshell.api.run("pset.edit_pset", ifcfile, pset=property_set, properties={name: str(value)})
+    ifcopenshell.api.run("pset.edit_pset", ifcfile, pset=property_set, properties={name: str(value) for name, value in properties.items()})
 
 def add_properties_to_element(ifcfile, element, properties):
     property_set = ifcopenshell.api.run("pset.add_pset", ifcfile, product=element, name="EscapeRouteProperties")
-    for name, value in properties.items():
-        ifcopenshell.api.run("pset.edit_pset", ifcfile, pset=property_set, properties={name: str(value)})
+    ifcopenshell.api.run("pset.edit_pset", ifcfile, pset=property_set, properties={name: str(value) for name, value in properties.items()})
 
 def create_site(ifc_file, project):
     site = ifc_file.create_entity("IfcSite", GlobalId=ifcopenshell.guid.new(), Name="Site")
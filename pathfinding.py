@@ -1,3 +1,4 @@
+import copy
 import math
 import networkx as nx
 import numpy as np
@@ -7,9 +8,22 @@ from collections import defaultdict
 import logging
 import traceback
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Maximum travel distances in metres used by check_escape_route_rules
+MAX_TRAVEL_DISTANCES = {
+    'daytime': {
+        'toEvacRoute': 30,
+        'toNearestExit': 45,
+        'toSecondExit': 80
+    },
+    'nighttime': {
+        'toEvacRoute': 20,
+        'toNearestExit': 30,
+        'toSecondExit': 60
+    }
+}
+
 class Pathfinder:
     def __init__(self, original_grids: List[List[List[str]]], buffered_grids: List[List[List[str]]], grid_size: float, floors: List[Dict[str, float]], bbox: Dict[str, float], allow_diagonal: bool = True, minimize_cost: bool = False):
         self.original_grids = original_grids
@@ -21,10 +35,35 @@ class Pathfinder:
         self.allow_diagonal = allow_diagonal
         self.minimize_cost = minimize_cost
         self.graph = None
+        self.stair_connections = []
+        self.stair_connections_by_floor = {}
 
     def create_graph(self):
         self.graph = self._create_graph()
         return self.graph
+
+    def get_stair_connections(self, floor: int = None) -> List[Dict[str, List[int]]]:
+        if floor is None:
+            return self.stair_connections
+        return self.stair_connections_by_floor.get(floor, [])
+
+    def with_diagonal(self, allow_diagonal: bool) -> 'Pathfinder':
+        """Return a copy whose graph is derived from this one for the other allow_diagonal setting."""
+        pathfinder = copy.copy(self)
+        pathfinder.allow_diagonal = allow_diagonal
+        G = self.graph.copy()
+        if allow_diagonal:
+            for node, node_type in self.graph.nodes(data='type'):
+                x, y, floor = node
+                # Each diagonal pair is added once, weighted from the later node in scan order as in _create_graph
+                for neighbor in ((x - 1, y - 1, floor), (x - 1, y + 1, floor)):
+                    if neighbor in G:
+                        weight = self._get_edge_weight(node_type, neighbor=G.nodes[neighbor]['type'], is_diagonal=True)
+                        G.add_edge(node, neighbor, weight=weight)
+        else:
+            G.remove_edges_from([(u, v) for u, v in self.graph.edges() if u[2] == v[2] and u[0] != v[0] and u[1] != v[1]])
+        pathfinder.graph = G
+        return pathfinder
     
     def _create_graph(self) -> nx.Graph:
         G = nx.Graph()
@@ -49,7 +88,13 @@ class Pathfinder:
                                     weight = self._get_edge_weight(grid[x][y], neighbor=grid[n_x][n_y], is_diagonal=(dx != 0 and dy != 0))
                                     G.add_edge(node, neighbor, weight=weight)
         
-        self._connect_stairs(G)
+        # Cross-floor edges, recorded as they are added and listed under both of their floors,
+        # so neither this nor the lookups have to rescan every edge of the graph
+        self.stair_connections = [{'start': list(start), 'end': list(end)} for start, end in dict.fromkeys(self._connect_stairs(G))]
+        self.stair_connections_by_floor = {}
+        for connection in self.stair_connections:
+            for floor in {connection['start'][2], connection['end'][2]}:
+                self.stair_connections_by_floor.setdefault(floor, []).append(connection)
         
         return G
 
@@ -113,7 +158,8 @@ class Pathfinder:
 
         return visited
 
-    def _connect_stairs(self, G: nx.Graph):
+    def _connect_stairs(self, G: nx.Graph) -> List[Tuple[Tuple[int, int, int], Tuple[int, int, int]]]:
+        stair_edges = []
         angle = 35
         stair_angle = angle  # 55 degree angle for stairs
         num_directions = 8  # Number of directions to check
@@ -136,7 +182,7 @@ class Pathfinder:
                     grid_distance = int(round(horizontal_distance / self.grid_size))
 
                     #print(f"Height difference: {height_diff}")
-                    print(f"Calculated horizontal distance: {horizontal_distance}")
+                    logger.debug("Calculated horizontal distance: %s", horizontal_distance)
                     #print(f"Grid distance: {grid_distance}")
 
                     connections_made = 0
@@ -153,6 +199,7 @@ class Pathfinder:
                                         weight = self._calculate_stair_weight(start_node, end_node, grid_height)
                                         #logger.debug(weight)
                                         G.add_edge(start_node, end_node, weight=weight)
+                                        stair_edges.append((start_node, end_node))
                                         connections_made += 1
                                         break
                                     #print(f"Connected {start_node} to {end_node} with weight {weight}")
@@ -163,10 +210,12 @@ class Pathfinder:
                     else:
                         iter_angle += 10
                 if connections_made == 0:
-                    print(f"No connections made between floors {lower_floor} and {upper_floor}, using fallback method")
-                    self._connect_stairs_fallback(G, lower_stairs, upper_stairs)
+                    logger.debug("No connections made between floors %s and %s, using fallback method", lower_floor, upper_floor)
+                    stair_edges += self._connect_stairs_fallback(G, lower_stairs, upper_stairs)
                 else:
-                    print(f"Made {connections_made} connections between floors {lower_floor} and {upper_floor} at angle {iter_angle}")
+                    logger.debug("Made %s connections between floors %s and %s at angle %s", connections_made, lower_floor, upper_floor, iter_angle)
+
+        return stair_edges
 
     def _check_stair_connection(self, start_x, start_y, start_floor, end_x, end_y, end_floor, grid_distance, num_directions):
         angle_step = 2 * math.pi / num_directions
@@ -213,12 +262,15 @@ class Pathfinder:
         return self._get_edge_weight(cell_type='stair', neighbor='stair') * grid_units_distance
 
     def _connect_stairs_fallback(self, G, lower_stairs, upper_stairs):
+        stair_edges = []
         for lower_x, lower_y, lower_floor in lower_stairs:
             for upper_x, upper_y, upper_floor in upper_stairs:
                 node1 = (lower_x, lower_y, lower_floor)
                 node2 = (upper_x, upper_y, upper_floor)
                 if node1 in G and node2 in G:
                     G.add_edge(node1, node2, weight=self._get_edge_weight('stair'))
+                    stair_edges.append((node1, node2))
+        return stair_edges
         
     def _calculate_path_lengths(self, path: List[Tuple[int, int, int]]) -> Dict[str, float]:
         total_length = 0
@@ -244,7 +296,7 @@ class Pathfinder:
 
             total_length += edge_length
         
-        print(total_length)
+        logger.debug("Total path length: %s", total_length)
 
         return {
             "total_length": total_length,
@@ -255,49 +307,55 @@ class Pathfinder:
     def detect_exits(self) -> List[Tuple[int, int, int]]:
         exits = []
         for floor_index, floor in enumerate(self.grids):
+            # Works on arrays, so grids decoded from a request don't need converting to nested lists first
+            floor = np.asarray(floor)
             door_groups = self._group_connected_doors(floor)
+            blocked = (floor == 'wall') | (floor == 'door')
             for door_group in door_groups:
-                if self._is_exit_group(floor, door_group):
+                if self._is_exit_group(blocked, door_group):
                     exit_coords = self._calculate_average_position(door_group, floor_index)
                     exits.append(exit_coords)
         return exits
 
-    def _group_connected_doors(self, floor: List[List[str]]) -> List[List[Tuple[int, int]]]:
-        rows, cols = len(floor), len(floor[0])
+    def _group_connected_doors(self, floor: np.ndarray) -> List[List[Tuple[int, int]]]:
+        # Only the door cells are visited; the scan for them is done by numpy, in the same row-major order
+        door_cells = list(map(tuple, np.argwhere(floor == 'door').tolist()))
+        doors = set(door_cells)
         visited = set()
         door_groups = []
 
-        def dfs(x, y, group):
-            if (x, y) in visited or not (0 <= x < rows and 0 <= y < cols) or floor[x][y] != 'door':
-                return
-            visited.add((x, y))
-            group.append((x, y))
-            for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-                dfs(x + dx, y + dy, group)
-
-        for i in range(rows):
-            for j in range(cols):
-                if floor[i][j] == 'door' and (i, j) not in visited:
-                    group = []
-                    dfs(i, j, group)
-                    door_groups.append(group)
+        for start in door_cells:
+            if start in visited:
+                continue
+            visited.add(start)
+            group = []
+            stack = [start]
+            while stack:
+                x, y = stack.pop()
+                group.append((x, y))
+                for neighbor in ((x, y + 1), (x + 1, y), (x, y - 1), (x - 1, y)):
+                    if neighbor in doors and neighbor not in visited:
+                        visited.add(neighbor)
+                        stack.append(neighbor)
+            door_groups.append(group)
 
         return door_groups
 
-    def _is_exit_group(self, floor: List[List[str]], door_group: List[Tuple[int, int]]) -> bool:
-        rows, cols = len(floor), len(floor[0])
+    def _is_exit_group(self, blocked: np.ndarray, door_group: List[Tuple[int, int]]) -> bool:
+        """Whether a straight line from a door reaches the edge of the grid without hitting a wall or door."""
+        rows, cols = blocked.shape
         directions = [(0, 1), (1, 0), (0, -1), (-1, 0)]
 
         for x, y in door_group:
             for dx, dy in directions:
                 nx, ny = x + dx, y + dy
-                if 0 <= nx < rows and 0 <= ny < cols and floor[nx][ny] not in ['wall', 'door']:
-                    while 0 <= nx < rows and 0 <= ny < cols:
-                        if floor[nx][ny] in ['wall', 'door']:
-                            break
-                        if nx == 0 or nx == rows - 1 or ny == 0 or ny == cols - 1:
+                if 0 <= nx < rows and 0 <= ny < cols and not blocked[nx, ny]:
+                    # Along a border row or column the first free cell is already on the edge
+                    if dx == 0:
+                        if x == 0 or x == rows - 1 or not blocked[x, ny::dy].any():
                             return True
-                        nx, ny = nx + dx, ny + dy
+                    elif y == 0 or y == cols - 1 or not blocked[nx::dx, y].any():
+                        return True
 
         return False
 
@@ -316,38 +374,31 @@ class Pathfinder:
             invalid_goals = [node for node in goal_nodes if node not in self.graph]
             raise ValueError(f"The following goal nodes are not in the graph: {invalid_goals}")
         
-        # TESTING, ONLY DO LAST TWO FLOORS
-
-
-        def heuristic(a, b):
-            (x1, y1, z1) = a
-            (x2, y2, z2) = b
-            return ((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5 + (abs(z1 - z2)*3) ** 2
-
-        path = None
-        shortest_length = float('inf')
-        for goal in goal_nodes:
-            try:
-                current_path = nx.astar_path(self.graph, start_node, goal, heuristic, weight='weight')
-                current_length = sum(self.graph[current_path[i]][current_path[i+1]]['weight'] for i in range(len(current_path)-1))
-                if current_length < shortest_length:
-                    path = current_path
-                    shortest_length = current_length
-            except nx.NetworkXNoPath:
-                continue
-
-        if not path:
+        # One Dijkstra search grown from all goals at once reaches the nearest goal first,
+        # instead of a separate A* search per goal; the graph is undirected, so the path is just reversed
+        try:
+            _, path = nx.multi_source_dijkstra(self.graph, set(goal_nodes), target=start_node, weight='weight')
+        except nx.NetworkXNoPath:
             return [], {}
+        path = path[::-1]
 
         path_lengths = self._calculate_path_lengths(path)
         return path, path_lengths
     
-    def calculate_escape_route(self, space: Dict[str, Any], exits: List[Tuple[int, int, int]], spaces: List[Dict[str, Any]]) -> Dict[str, Any]:
+    def calculate_escape_routes(self, route_spaces: List[Dict[str, Any]], exits: List[Tuple[int, int, int]], spaces: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Escape routes for several spaces, sharing the stairway lookup between them."""
+        stairways = self._stairway_lookup(spaces)
+        return [self.calculate_escape_route(space, exits, spaces, stairways) for space in route_spaces]
+
+    def calculate_escape_route(self, space: Dict[str, Any], exits: List[Tuple[int, int, int]], spaces: List[Dict[str, Any]], stairways: Dict[int, List[Tuple[set, set]]] = None) -> Dict[str, Any]:
         try:
             #logger.debug(f"Calculating escape route for space: {space['name']}")
             candidate_points = self._select_candidate_points(space)
             #logger.debug(f"Candidate points: {candidate_points}")
             
+            if stairways is None:
+                stairways = self._stairway_lookup(spaces)
+
             max_distance = 0
             furthest_point = None
             optimal_exit = None
@@ -373,16 +424,16 @@ class Pathfinder:
 
                     try:
                         path = nx.astar_path(self.graph, point, exit, heuristic=self._heuristic, weight='weight')
-                        distance = sum(self.graph[path[i]][path[i+1]]['weight'] for i in range(len(path)-1))
+                        distance = nx.path_weight(self.graph, path, weight='weight')
                         
                         #stair_index = next((i for i, node in enumerate(path) if self.grids[node[2]][node[0]][node[1]] == 'stair'), -1)
                         
                         # Find index of first node that belongs to a stairway space
                         stair_index = next((i for i, node in enumerate(path) 
-                                            if self._is_node_in_stairway_space(node, spaces)), -1)  # Pass spaces here
+                                            if self._is_node_in_stairway_space(node, stairways)), -1)
                         
                         if stair_index != -1:
-                            stair_distance = sum(self.graph[path[i]][path[i+1]]['weight'] for i in range(stair_index))
+                            stair_distance = nx.path_weight(self.graph, path[:stair_index + 1], weight='weight')
                             current_distance_to_stair = stair_distance if current_distance_to_stair == -1 else min(current_distance_to_stair, stair_distance)
                         
                         if distance < min_exit_distance:
@@ -447,28 +498,25 @@ class Pathfinder:
             logger.error(traceback.format_exc())
             raise
     
-    def _is_node_in_stairway_space(self, node: Tuple[int, int, int], spaces: List[Dict[str, Any]]) -> bool:
-        """Check if a node belongs to a space marked as a stairway."""
+    def _stairway_lookup(self, spaces: List[Dict[str, Any]]) -> Dict[int, List[Tuple[set, set]]]:
+        """Row and column sets of every stairway space, grouped by floor."""
+        stairways = defaultdict(list)
         for space in spaces:
-            if space['is_stairway'] and node[0] in [p[0] for p in space['points']] and node[1] in [p[1] for p in space['points']] and node[2] == space['floor']:
-                return True
-        return False
+            if space['is_stairway']:
+                stairways[space['floor']].append(({p[0] for p in space['points']}, {p[1] for p in space['points']}))
+        return stairways
+
+    def _is_node_in_stairway_space(self, node: Tuple[int, int, int], stairways: Dict[int, List[Tuple[set, set]]]) -> bool:
+        """Check if a node belongs to a space marked as a stairway."""
+        return any(node[0] in rows and node[1] in cols for rows, cols in stairways.get(node[2], ()))
     
     def _calculate_real_distance(self, path: List[Tuple[int, int, int]]) -> float:
-        total_distance = 0
-        for i in range(len(path) - 1):
-            x1, y1, z1 = path[i]
-            x2, y2, z2 = path[i+1]
-            
-            # Calculate 3D Euclidean distance
-            dx = (x2 - x1) * self.grid_size
-            dy = (y2 - y1) * self.grid_size
-            dz = (self.floors[z2]['elevation'] - self.floors[z1]['elevation'])
-            
-            distance = math.sqrt(dx**2 + dy**2 + dz**2)
-            total_distance += distance
-        
-        return total_distance
+        # Sum of the 3D Euclidean lengths of all path steps
+        nodes = np.asarray(path)
+        elevations = np.array([floor['elevation'] for floor in self.floors])
+        steps = np.diff(nodes[:, :2], axis=0) * self.grid_size
+        rises = np.diff(elevations[nodes[:, 2]])
+        return float(np.sqrt(steps[:, 0] ** 2 + steps[:, 1] ** 2 + rises ** 2).sum())
     
     def _select_candidate_points(self, space: Dict[str, Any]) -> List[Tuple[int, int, int]]:
         points = np.array(space['points'])
@@ -502,9 +550,10 @@ def find_path(grids: List[List[List[str]]], grid_size: float, floors: List[Dict[
               start: Dict[str, int], goals: List[Dict[str, int]], allow_diagonal: bool = False, minimize_cost: bool = True) -> Tuple[List[Tuple[int, int, int]], Dict[str, float]]:
     try:
         pathfinder = Pathfinder(grids, grids, grid_size, floors, bbox, allow_diagonal, minimize_cost)
+        pathfinder.create_graph()
         return pathfinder.find_path(start, goals)
     except Exception as e:
-        print(f"Error in find_path: {str(e)}")
+        logger.debug("Error in find_path: %s", e)
         raise
 
 def detect_exits(grids: List[List[List[str]]], grid_size: float, floors: List[Dict[str, float]], bbox: Dict[str, float]) -> List[Tuple[int, int, int]]:
@@ -512,22 +561,22 @@ def detect_exits(grids: List[List[List[str]]], grid_size: float, floors: List[Di
         pathfinder = Pathfinder(grids, grids, grid_size, floors, bbox)
         return pathfinder.detect_exits()
     except Exception as e:
-        print(f"Error in detect_exits: {str(e)}")
+        logger.debug("Error in detect_exits: %s", e)
         raise
 
 def calculate_escape_route(grids: List[List[List[str]]], grid_size: float, floors: List[Dict[str, float]], 
                            bbox: Dict[str, float], space: Dict[str, Any], exits: List[Tuple[int, int, int]], 
                            allow_diagonal: bool = False) -> Dict[str, Any]:
     try:
-        logger.debug(f"Calculating escape route for space: {space['name']}")
-        logger.debug(f"Grid size: {grid_size}, Floors: {floors}, Bbox: {bbox}")
-        logger.debug(f"Exits: {exits}, Allow diagonal: {allow_diagonal}")
+        logger.debug("Calculating escape route for space: %s", space['name'])
+        logger.debug("Grid size: %s, Floors: %s, Bbox: %s", grid_size, floors, bbox)
+        logger.debug("Exits: %s, Allow diagonal: %s", exits, allow_diagonal)
         
         pathfinder = Pathfinder(grids, grids, grid_size, floors, bbox, allow_diagonal)
         pathfinder.create_graph()
         result = pathfinder.calculate_escape_route(space, exits, spaces)
         
-        logger.debug(f"Escape route calculation result: {result}")
+        logger.debug("Escape route calculation result: %s", result)
         return result
     except Exception as e:
         logger.error(f"Error in calculate_escape_route: {str(e)}")
@@ -542,12 +591,9 @@ def calculate_escape_routes(grids: List[List[List[str]]], grid_size: float, floo
         pathfinder = Pathfinder(grids, grids, grid_size, floors, bbox, allow_diagonal)
         pathfinder.create_graph()  # Create the graph once
         
-        results = []
-        for space in spaces:
-            result = pathfinder.calculate_escape_route(space, exits, spaces)
-            violations = check_escape_route_rules(result, grid_size)
-            result['violations'] = violations
-            results.append(result)
+        results = pathfinder.calculate_escape_routes(spaces, exits, spaces)
+        for result in results:
+            result['violations'] = check_escape_route_rules(result, grid_size)
         
         return results
     except Exception as e:
@@ -562,28 +608,14 @@ def check_escape_route_rules(route, grid_size):
         'nighttime': []
     }
 
-    max_travel_distances = {
-        'daytime': {
-            'toEvacRoute': 30,
-            'toNearestExit': 45,
-            'toSecondExit': 80
-        },
-        'nighttime': {
-            'toEvacRoute': 20,
-            'toNearestExit': 30,
-            'toSecondExit': 60
-        }
-    }
-    print("Distance to stair:")
-    print(route['distance_to_stair'])
-    print("Distance to exit:")
-    print(route['distance'])
+    # Lazy %s formatting: this runs for every route, and the message is dropped unless LOG_LEVEL is DEBUG
+    logger.debug("Distance to stair: %s, distance to exit: %s", route['distance_to_stair'], route['distance'])
     for time_of_day in ['daytime', 'nighttime']:
-        if route['distance_to_stair'] and route['distance_to_stair'] > max_travel_distances[time_of_day]['toEvacRoute']:
-            violations[time_of_day].append(f"Distance to evacuation route ({route['distance_to_stair']:.2f}m) exceeds maximum ({max_travel_distances[time_of_day]['toEvacRoute']}m)")
+        if route['distance_to_stair'] and route['distance_to_stair'] > MAX_TRAVEL_DISTANCES[time_of_day]['toEvacRoute']:
+            violations[time_of_day].append(f"Distance to evacuation route ({route['distance_to_stair']:.2f}m) exceeds maximum ({MAX_TRAVEL_DISTANCES[time_of_day]['toEvacRoute']}m)")
         
-        if route['distance'] and route['distance'] > max_travel_distances[time_of_day]['toNearestExit']:
-            violations[time_of_day].append(f"Distance to nearest exit ({route['distance']:.2f}m) exceeds maximum ({max_travel_distances[time_of_day]['toNearestExit']}m)")
+        if route['distance'] and route['distance'] > MAX_TRAVEL_DISTANCES[time_of_day]['toNearestExit']:
+            violations[time_of_day].append(f"Distance to nearest exit ({route['distance']:.2f}m) exceeds maximum ({MAX_TRAVEL_DISTANCES[time_of_day]['toNearestExit']}m)")
 
     # Check dead-end length (if available)
     if 'dead_end_length' in route and route['dead_end_length'] > 15:
@@ -601,5 +633,5 @@ def check_escape_route_rules(route, grid_size):
     
     if not route['distance']:
         violations['general'].append("No escape route found!")
-    print(violations)
+    logger.debug("Escape route violations: %s", violations)
     return violations
\ No newline at end of file
@@ -43,11 +43,20 @@ let showBuffer = false;
 let showSpaces = true;
 let cellBufferScale = 100;
 let stairConnections = null;
+let graphKey = null;
+let gridId = null;
 let file = null;
 let isIFC = null;
 let ifcExists = false;
 let global_ifc_file = null;
 
+// Cell types in the order of the byte codes used when grids are sent packed
+const CELL_TYPES = ['empty', 'floor', 'stair', 'wall', 'door', 'walla'];
+const CELL_CODES = Object.fromEntries(CELL_TYPES.map((type, code) => [type, code]));
+
+// Number of spaces sent per escape route request
+const ESCAPE_ROUTE_BATCH_SIZE = 8;
+
 const MAX_TRAVEL_DISTANCES = {
     daytime: {
         toEvacRoute: 30,
@@ -237,10 +246,10 @@ async function uploadFile(event) {
         } else {
             isIFC = true;
             // Handle IFC file
-            const response = await fetch('/api/process-file', {
+            const response = await awaitTask(await fetch('/api/process-file', {
                 method: 'POST',
                 body: formData
-            });
+            }));
 
             if (!response.ok) {
                 throw new Error('Network response was not ok');
@@ -259,6 +268,16 @@ async function uploadFile(event) {
     }
 }
 
+// Long-running requests answer 202 with a task id; poll until the task's real response is ready
+async function awaitTask(response) {
+    while (response.status === 202) {
+        const { task_id } = await response.json();
+        await new Promise(resolve => setTimeout(resolve, 250));
+        response = await fetch(`/api/task/${task_id}`);
+    }
+    return response;
+}
+
 async function checkIfcFileExists(fileName) {
     try {
         const response = await fetch('/api/check-ifc-file', {
@@ -282,8 +301,9 @@ function exportGrid() {
         return;
     }
 
+    // Saved in the same packed form as the API uses; handleProcessedData unpacks it again on load
     const dataToSave = {
-        grids: originalGridData.grids,
+        grids: packGrids(originalGridData.grids),
         grid_size: originalGridData.grid_size,
         floors: originalGridData.floors,
         bbox: originalGridData.bbox,
@@ -309,7 +329,60 @@ function exportGrid() {
     URL.revokeObjectURL(url);
 }
 
+function packGrids(grids) {
+    const floors = grids.length;
+    const rows = grids[0].length;
+    const cols = grids[0][0].length;
+    const codes = new Uint8Array(floors * rows * cols);
+    let i = 0;
+    for (const grid of grids) {
+        for (const row of grid) {
+            for (const cell of row) {
+                codes[i++] = CELL_CODES[cell];
+            }
+        }
+    }
+    let binary = '';
+    for (let offset = 0; offset < codes.length; offset += 0x8000) {
+        binary += String.fromCharCode.apply(null, codes.subarray(offset, offset + 0x8000));
+    }
+    return { shape: [floors, rows, cols], data: btoa(binary) };
+}
+
+function unpackGrids(packed) {
+    if (Array.isArray(packed)) {
+        return packed;
+    }
+    const [floors, rows, cols] = packed.shape;
+    const binary = atob(packed.data);
+    const grids = [];
+    let i = 0;
+    for (let f = 0; f < floors; f++) {
+        const grid = [];
+        for (let r = 0; r < rows; r++) {
+            const row = new Array(cols);
+            for (let c = 0; c < cols; c++) {
+                row[c] = CELL_TYPES[binary.charCodeAt(i++)];
+            }
+            grid.push(row);
+        }
+        grids.push(grid);
+    }
+    return grids;
+}
+
+function applyGridPatch(grid, origin, packedPatch) {
+    const [top, left] = origin;
+    unpackGrids(packedPatch)[0].forEach((patchRow, i) => {
+        const row = grid[top + i];
+        patchRow.forEach((cell, j) => {
+            row[left + j] = cell;
+        });
+    });
+}
+
 function handleProcessedData(data) {
+    data.grids = unpackGrids(data.grids);
     originalGridData = data;
     bufferedGridData = {...data};
     console.log(originalGridData.floors);
@@ -693,8 +766,9 @@ async function getStairConnections() {
             headers: {
                 'Content-Type': 'application/json'
             },
+            // No floor filter: the connections are kept while navigating between floors
             body: JSON.stringify({
-                floor: currentFloor
+                graph_key: graphKey
             })
         });
 
@@ -757,18 +831,11 @@ function renderStairConnections(ctx) {
 
 async function updateSpaces() {
     try {
-        const response = await fetch('/api/update-spaces', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                include_empty_tiles: includeEmptyTiles,
-                grids: bufferedGridData.grids,
-                grid_size: bufferedGridData.grid_size,
-                floors: bufferedGridData.floors,
-                bbox: bufferedGridData.bbox,
-            })
+        const response = await postBufferedGrids('/api/update-spaces', {
+            include_empty_tiles: includeEmptyTiles,
+            grid_size: bufferedGridData.grid_size,
+            floors: bufferedGridData.floors,
+            bbox: bufferedGridData.bbox,
         });
         const data = await response.json();
         if (response.ok) {
@@ -1295,14 +1362,9 @@ async function findPath() {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                grids: bufferedGridData.grids,
-                grid_size: bufferedGridData.grid_size,
-                floors: bufferedGridData.floors,
-                bbox: bufferedGridData.bbox,
+                graph_key: graphKey,
                 start: start,
-                goals: goals,
-                allow_diagonal: allowDiagonal,
-                minimize_cost: minimizeCost
+                goals: goals
             })
         });
         const data = await response.json();
@@ -1352,20 +1414,12 @@ async function createOrFetchGraph() {
     console.log("Original grids:", originalGridData.grids);
     console.log("Buffered grids:", bufferedGridData.grids);
 
-    const createGraphResponse = await fetch('/api/create-graph', {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-            original_grids: originalGridData.grids,
-            buffered_grids: bufferedGridData.grids,
-            grid_size: bufferedGridData.grid_size,
-            floors: bufferedGridData.floors,
-            bbox: bufferedGridData.bbox,
-            allow_diagonal: allowDiagonal,
-            minimize_cost: minimizeCost,
-        })
+    const createGraphResponse = await postBufferedGrids('/api/create-graph', {
+        grid_size: bufferedGridData.grid_size,
+        floors: bufferedGridData.floors,
+        bbox: bufferedGridData.bbox,
+        allow_diagonal: allowDiagonal,
+        minimize_cost: minimizeCost,
     });
 
     if (!createGraphResponse.ok) {
@@ -1373,6 +1427,9 @@ async function createOrFetchGraph() {
         console.error("Error response:", errorData);
         throw new Error(`HTTP error! status: ${createGraphResponse.status}, message: ${errorData.error || 'Unknown error'}`);
     }
+
+    const data = await createGraphResponse.json();
+    graphKey = data.graph_key;
 }
 
 async function calculateEscapeRoutes() {
@@ -1395,18 +1452,20 @@ async function calculateEscapeRoutes() {
         await createOrFetchGraph();
         await getStairConnections();
 
-        for (let i = 0; i < spacesData.length; i++) {
-            const space = spacesData[i];
-            updateProgress((i / spacesData.length) * 100, `Calculating route for space ${i + 1} of ${spacesData.length}`);
+        // Spaces are sent in batches: one request per batch, while still updating the progress in between
+        for (let i = 0; i < spacesData.length; i += ESCAPE_ROUTE_BATCH_SIZE) {
+            const batch = spacesData.slice(i, i + ESCAPE_ROUTE_BATCH_SIZE);
+            updateProgress((i / spacesData.length) * 100, `Calculating routes for spaces ${i + 1}-${i + batch.length} of ${spacesData.length}`);
 
             try {
-                const response = await fetch('/api/calculate-escape-route', {
+                const response = await fetch('/api/calculate-escape-routes', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json'
                     },
                     body: JSON.stringify({
-                        space: space,
+                        graph_key: graphKey,
+                        route_spaces: batch,
                         exits: goals.map(goal => [goal.row, goal.col, goal.floor]),
                         spaces: spacesData
                     })
@@ -1418,31 +1477,34 @@ async function calculateEscapeRoutes() {
                 }
 
                 const data = await response.json();
-                foundEscapeRoutes.push(data.escape_route);
-
-                // Check rules
-                const violations = data.escape_route.violations;
-                if (violations['general'].length > 0 || violations['daytime'].length > 0 || violations['nighttime'].length > 0) {
-                    spacesWithViolations.push({space: space.name, violations});
-                }
+                batch.forEach((space, j) => {
+                    const escapeRoute = data.escape_routes[j];
+                    foundEscapeRoutes.push(escapeRoute);
+
+                    // Check rules
+                    const violations = escapeRoute.violations;
+                    if (violations['general'].length > 0 || violations['daytime'].length > 0 || violations['nighttime'].length > 0) {
+                        spacesWithViolations.push({space: space.name, violations});
+                    }
 
-                // Update statistics
-                if (data.escape_route.distance) {
-                    totalLength = Math.max(totalLength, data.escape_route.distance);
-                    stairwayDistance = Math.max(stairwayDistance, data.escape_route.distance_to_stair);
-                    if (data.escape_route.distance_to_stair > maxStairDistance || data.escape_route.distance > maxStairDistance) {
-                        spacesOverMaxDistance.push(data.escape_route.space_name);
+                    // Update statistics
+                    if (escapeRoute.distance) {
+                        totalLength = Math.max(totalLength, escapeRoute.distance);
+                        stairwayDistance = Math.max(stairwayDistance, escapeRoute.distance_to_stair);
+                        if (escapeRoute.distance_to_stair > maxStairDistance || escapeRoute.distance > maxStairDistance) {
+                            spacesOverMaxDistance.push(escapeRoute.space_name);
+                        }
+                    } else {
+                        spacesWithoutExits.push(escapeRoute.space_name);
                     }
-                } else {
-                    spacesWithoutExits.push(data.escape_route.space_name);
-                }
+                });
 
                 // Render the current progress
                 displayViolations(spacesWithViolations);
                 renderGrid(bufferedGridData.grids[currentFloor]);
 
             } catch (error) {
-                console.error('Error calculating escape route for space:', space.name, error);
+                console.error('Error calculating escape routes for spaces:', batch.map(space => space.name), error);
             }
         }
 
@@ -1499,10 +1561,10 @@ async function updateIfcWithRoutes() {
     formData.append('floors', JSON.stringify(bufferedGridData.floors));
 
     try {
-        const response = await fetch('/api/update-ifc-with-routes', {
+        const response = await awaitTask(await fetch('/api/update-ifc-with-routes', {
             method: 'POST',
             body: formData
-        });
+        }));
 
         if (response.ok) {
             const blob = await response.blob();
@@ -1531,7 +1593,7 @@ async function exportPdfReport() {
     }
 
     try {
-        const response = await fetch('/api/generate-pdf-report', {
+        const response = await awaitTask(await fetch('/api/generate-pdf-report', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -1542,7 +1604,7 @@ async function exportPdfReport() {
                 floors: bufferedGridData.floors,
                 'filename': file.name
             })
-        });
+        }));
 
         if (!response.ok) {
             throw new Error('Network response was not ok');
@@ -1579,10 +1641,10 @@ async function handleIfcFileSelection(event) {
         formData.append('file', selectedFile);
 
         try {
-            const response = await fetch('/api/process-file', {
+            const response = await awaitTask(await fetch('/api/process-file', {
                 method: 'POST',
                 body: formData
-            });
+            }));
 
             if (!response.ok) {
                 throw new Error('Network response was not ok');
@@ -1653,7 +1715,7 @@ async function applyWallBuffer() {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                grids: originalGridData.grids,
+                grids: packGrids(originalGridData.grids),
                 wall_buffer: wallBuffer,
                 grid_size: originalGridData.grid_size,
                 floors: originalGridData.floors,
@@ -1662,7 +1724,9 @@ async function applyWallBuffer() {
         });
         const data = await response.json();
         if (response.ok) {
+            data.buffered_grids = unpackGrids(data.buffered_grids);
             if (Array.isArray(data.buffered_grids) && data.buffered_grids.every(Array.isArray)) {
+                gridId = data.grid_id;
                 bufferedGridData = {...originalGridData, grids: data.buffered_grids};
                 renderGrid(bufferedGridData.grids[currentFloor]);
             } else {
@@ -1677,6 +1741,23 @@ async function applyWallBuffer() {
     }
 }
 
+// Posts to an endpoint that works on the buffered grids, referring to them by gridId;
+// if the server no longer holds that grid, the request is repeated with the grids in full
+async function postBufferedGrids(url, body) {
+    const post = grids => fetch(url, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({...body, ...grids})
+    });
+    let response = await post({ grid_id: gridId });
+    if (response.status === 404 && (await response.clone().json()).grid_expired) {
+        response = await post({ grids: packGrids(bufferedGridData.grids) });
+    }
+    return response;
+}
+
 async function updateCell(floor, row, col, cellType) {
     try {
         const response = await fetch('/api/update-cell', {
@@ -1685,21 +1766,22 @@ async function updateCell(floor, row, col, cellType) {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                grids: originalGridData.grids,
+                grid_id: gridId,
                 floor: floor,
                 row: row,
                 col: col,
                 cell_type: cellType,
-                wall_buffer: wallBuffer,
-                grid_size: originalGridData.grid_size,
-                floors: originalGridData.floors,
-                bbox: originalGridData.bbox
+                wall_buffer: wallBuffer
             })
         });
         const data = await response.json();
-        if (response.ok) {
-            originalGridData.grids = data.original_grids;
-            bufferedGridData = {...originalGridData, grids: data.buffered_grids};
+        if (data.grid_expired) {
+            // The server no longer holds this grid; resend it in full (the edit is already applied locally)
+            originalGridData.grids[floor][row][col] = cellType;
+            await applyWallBuffer();
+        } else if (response.ok) {
+            originalGridData.grids[floor][row][col] = cellType;
+            applyGridPatch(bufferedGridData.grids[data.floor], data.origin, data.buffered_patch);
         } else {
             throw new Error(data.error || 'An error occurred while updating the cell.');
         }
@@ -1717,18 +1799,25 @@ async function batchUpdateCells(updates) {
                 'Content-Type': 'application/json'
             },
             body: JSON.stringify({
-                grids: originalGridData.grids,
+                grid_id: gridId,
                 updates: updates,
-                wall_buffer: wallBuffer,
-                grid_size: originalGridData.grid_size,
-                floors: originalGridData.floors,
-                bbox: originalGridData.bbox
+                wall_buffer: wallBuffer
             })
         });
         const data = await response.json();
-        if (response.ok) {
-            originalGridData.grids = data.original_grids;
-            bufferedGridData = {...originalGridData, grids: data.buffered_grids};
+        if (data.grid_expired) {
+            // The server no longer holds this grid; resend it in full (the edits are already applied locally)
+            updates.forEach(({ floor, row, col, type }) => {
+                originalGridData.grids[floor][row][col] = type;
+            });
+            await applyWallBuffer();
+        } else if (response.ok) {
+            updates.forEach(({ floor, row, col, type }) => {
+                originalGridData.grids[floor][row][col] = type;
+            });
+            data.patches.forEach(patch => {
+                applyGridPatch(bufferedGridData.grids[patch.floor], patch.origin, patch.buffered_patch);
+            });
         } else {
             throw new Error(data.error || 'An error occurred while updating cells.');
         }
@@ -1740,17 +1829,10 @@ async function batchUpdateCells(updates) {
 
 async function detectExits() {
     try {
-        const response = await fetch('/api/detect-exits', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                grids: bufferedGridData.grids,
-                grid_size: bufferedGridData.grid_size,
-                floors: bufferedGridData.floors,
-                bbox: bufferedGridData.bbox
-            })
+        const response = await postBufferedGrids('/api/detect-exits', {
+            grid_size: bufferedGridData.grid_size,
+            floors: bufferedGridData.floors,
+            bbox: bufferedGridData.bbox
         });
         const data = await response.json();
         if (response.ok) {
@@ -0,0 +1,4 @@
+# WSGI entry point for running the app behind a production server, e.g.
+#   gunicorn --workers 1 --threads 8 --timeout 600 wsgi:app
+# Grids, graphs and background tasks are kept in memory, so use a single worker process.
+from app import app